@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+# Copyright (c) 2014 Wladimir J. van der Laan
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+Incremental bake of derived artifacts (render-ready cache, statistics,
+cubemap, thumbnail and levels of detail) for whole directories or .big
+archives of backgrounds.
+
+Every artifact is keyed by the content hash of its input, the version of
+the tool that produces it and its parameters; thumbnails are keyed by the
+cubemap they are made from. Only outputs whose key changed are rebuilt.
+
+Render-ready caches and levels of detail are built the way the viewer
+builds them and written to the viewer's cache directory, under the names
+the viewer looks for. As the viewer writes and replaces those files too,
+they are also checked against the source hash and restart mode in their
+own header.
+'''
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+import sys
+import time
+
+from big_archive import open_archive, read_big_path, split_big_path
+from bg_cache import HWBG_VERSION, cache_digest, cache_path, options_suffix
+from hod_fsck import find_hods
+
+# Bump the version of an artifact when the code that generates it changes.
+# Render-ready caches also change with the cache layout version.
+TOOL_VERSIONS = {
+    'hwbg': f'{HWBG_VERSION}.3',
+    'stats': 1,
+    'cubemap': 1,
+    'thumbnail': 1,
+    'lods': f'{HWBG_VERSION}.3',
+}
+ARTIFACTS = list(TOOL_VERSIONS)
+# Artifacts that are derived from other artifacts instead of from the input
+DEPENDS = {
+    'thumbnail': 'cubemap',
+}
+STATE_FILE = 'bake_state.json'
+
+def list_inputs(paths):
+    '''
+    (input path, output base name) for every HOD in the given files,
+    directories and .big archives.
+    '''
+    for path in paths:
+        if path.lower().endswith('.big') and os.path.isfile(path):
+            for name, i in sorted(open_archive(path).match('*.hod')):
+                yield (f'{path}:{name}', os.path.splitext(name)[0])
+        elif os.path.isdir(path):
+            for filename in find_hods([path]):
+                yield (filename, os.path.splitext(os.path.relpath(filename, path))[0])
+        else:
+            yield (path, os.path.splitext(os.path.basename(path))[0])
+
+def input_stat(path):
+    archive, member = split_big_path(path)
+    if archive is None:
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+    big = open_archive(archive)
+    i = big.lookup(member)
+    return [int(big.files[i]['decompressed_len']), big.mtime(i)]
+
+def read_input(path):
+    data = read_big_path(path)
+    if data is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+    return data
+
+def output_files(path, base, artifact, params):
+    if artifact == 'hwbg':
+        return [cache_path(path, options_suffix(rebased=params['hwbg']['rebased']))]
+    if artifact == 'stats':
+        return [base + '.stats.json']
+    if artifact == 'cubemap':
+        from softrender import CUBE_FACES
+        return [f'{base}.cube_{face[0]}.png' for face in CUBE_FACES]
+    if artifact == 'thumbnail':
+        return [base + '.thumb.png']
+    if artifact == 'lods':
+        return [cache_path(path, options_suffix(max_triangles=n, rebased=params['lods']['rebased']))
+                for n in params['lods']['triangles']]
+
+def outputs_current(path, base, artifact, params, digest):
+    '''
+    Whether the output files of an artifact exist, and for files in the
+    viewer's cache, whether they were built from this content.
+    '''
+    files = output_files(path, base, artifact, params)
+    if artifact in ('hwbg', 'lods'):
+        restart_mode = params[artifact]['restart_mode']
+        return all(cache_digest(f, restart_mode) == bytes.fromhex(digest) for f in files)
+    return all(os.path.exists(f) for f in files)
+
+def artifact_keys(digest, params):
+    '''
+    Keys of all artifacts of an input with content hash digest.
+    '''
+    keys = {}
+    for artifact in ARTIFACTS:
+        source = keys[DEPENDS[artifact]] if artifact in DEPENDS else digest
+        keyparams = json.dumps(params.get(artifact), sort_keys=True)
+        keys[artifact] = hashlib.sha256(
+                f'{source}:{artifact}:{TOOL_VERSIONS[artifact]}:{keyparams}'.encode()).hexdigest()
+    return keys
+
+def background_stats(bgdata):
+    import numpy
+    from mesh_ops import facelists_to_triangles
+    meshes = []
+    for numverts,vertsize,vertdata,facelists in bgdata:
+        radius = numpy.linalg.norm(vertdata['position'][:, :3], axis=1)
+        meshes.append({
+            'numverts': numverts,
+            'vertsize': vertsize,
+            'numfacelists': len(facelists),
+            'numindices': sum(count for typ, count, facedata in facelists),
+            'numtriangles': len(facelists_to_triangles(facelists)),
+            'radius': [float(radius.min()), float(radius.max())] if numverts else None,
+        })
+    totals = {key: sum(m[key] for m in meshes) for key in ('numverts', 'numindices', 'numtriangles')}
+    return {'meshes': meshes, 'totals': totals}
+
+def bake_input(path, base, digest, artifacts, params):
+    '''
+    Worker: build the given artifacts for one input.
+    '''
+    import numpy
+    from bg_cache import save_cache
+    from decimate import lod_chain
+    from parse_bg import parse_bg
+    from mesh_ops import PRIMITIVE_RESTART_NONE, build_buffers, triangulate
+    import softrender
+
+    bgdata = parse_bg(path, as_numpy=True)
+    os.makedirs(os.path.dirname(base) or '.', exist_ok=True)
+    if 'hwbg' in artifacts:
+        restart_mode = params['hwbg']['restart_mode']
+        # as in visualize.load_background with default options
+        buffers = build_buffers(triangulate(bgdata) if restart_mode == PRIMITIVE_RESTART_NONE else bgdata,
+                                restart_mode, params['hwbg']['rebased'])
+        filename, = output_files(path, base, 'hwbg', params)
+        save_cache(filename, path, restart_mode, *buffers, digest=bytes.fromhex(digest))
+    if 'stats' in artifacts:
+        with open(base + '.stats.json', 'w') as f:
+            json.dump(background_stats(bgdata), f, indent=1)
+    if 'lods' in artifacts:
+        restart_mode = params['lods']['restart_mode']
+        levels = [(n, None) for n in params['lods']['triangles']]
+        for filename, (lod, error) in zip(output_files(path, base, 'lods', params), lod_chain(bgdata, levels) if levels else []):
+            # levels are triangle lists, which need no primitive restart
+            buffers = build_buffers(lod, restart_mode, params['lods']['rebased'])
+            save_cache(filename, path, restart_mode, *buffers, digest=bytes.fromhex(digest))
+    if 'cubemap' in artifacts or 'thumbnail' in artifacts:
+        faces = softrender.render_cubemap(bgdata, params['cubemap']['size'])
+        if 'cubemap' in artifacts:
+            for face, filename in zip(softrender.CUBE_FACES, output_files(path, base, 'cubemap', params)):
+                softrender.write_png(filename, faces[face[0]])
+        if 'thumbnail' in artifacts:
+            softrender.write_png(base + '.thumb.png', softrender.equirectangular(faces, params['thumbnail']['width']))
+    return path
+
+def load_state(outdir):
+    try:
+        with open(os.path.join(outdir, STATE_FILE), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'inputs': {}, 'outputs': {}}
+
+def save_state(outdir, state):
+    filename = os.path.join(outdir, STATE_FILE)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+def bake(paths, outdir, params, jobs=None):
+    '''
+    Bring all artifacts for the inputs in outdir up to date. Returns
+    (number of inputs, number of jobs run, number of failures).
+    '''
+    os.makedirs(outdir, exist_ok=True)
+    state = load_state(outdir)
+    work = []
+    inputs = list(list_inputs(paths))
+    for path, name in inputs:
+        stat = input_stat(path)
+        known = state['inputs'].get(path)
+        if known is not None and known['stat'] == stat:
+            digest = known['hash']
+        else:
+            digest = hashlib.sha256(read_input(path)).hexdigest()
+            state['inputs'][path] = {'stat': stat, 'hash': digest}
+        base = os.path.join(outdir, name)
+        keys = artifact_keys(digest, params)
+        stale = [artifact for artifact in ARTIFACTS
+                 if state['outputs'].get(f'{base}:{artifact}') != keys[artifact] or
+                    not outputs_current(path, base, artifact, params, digest)]
+        if stale:
+            work.append((path, base, digest, stale, keys))
+
+    failed = 0
+    if work:
+        with ProcessPoolExecutor(jobs) as pool:
+            futures = [(pool.submit(bake_input, path, base, digest, stale, params), base, stale, keys)
+                       for path, base, digest, stale, keys in work]
+            for future, base, stale, keys in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f'Warning: baking {base} failed: {e}', file=sys.stderr)
+                    failed += 1
+                    continue
+                for artifact in stale:
+                    state['outputs'][f'{base}:{artifact}'] = keys[artifact]
+    save_state(outdir, state)
+    return (len(inputs), len(work), failed)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Homeworld 2 background bake pipeline')
+    parser.add_argument('paths', metavar='PATH', nargs='+', help='HOD files, directories or .big archives')
+    parser.add_argument('-o', '--outdir', default='baked', help='Output directory')
+    parser.add_argument('-j', '--jobs', type=int, help='Number of worker processes')
+    parser.add_argument('--restart-mode', type=int, default=1, choices=[0, 1, 2], help='Primitive restart mode of the render-ready cache (0=none, 1=core, 2=NV)')
+    parser.add_argument('--rebased', action='store_true', help='Build render-ready caches for drivers without base vertex drawing')
+    parser.add_argument('--cubemap-size', type=int, default=256, help='Size of cubemap faces in pixels')
+    parser.add_argument('--lod-triangles', type=int, nargs='*', default=[], help='Triangle budgets of levels of detail to bake, in decreasing order')
+    parser.add_argument('--thumbnail-width', type=int, default=256, help='Width of panorama thumbnails in pixels')
+    args = parser.parse_args()
+
+    params = {
+        'hwbg': {'restart_mode': args.restart_mode, 'rebased': args.rebased},
+        'cubemap': {'size': args.cubemap_size},
+        'thumbnail': {'width': args.thumbnail_width},
+        'lods': {'triangles': args.lod_triangles, 'restart_mode': args.restart_mode, 'rebased': args.rebased},
+    }
+    start = time.perf_counter()
+    inputs, jobs, failed = bake(args.paths, args.outdir, params, args.jobs)
+    print(f'{inputs} inputs, {jobs} rebuilt, {failed} failed in {time.perf_counter() - start:.2f} s')
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
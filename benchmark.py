@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+# Copyright (c) 2014 Wladimir J. van der Laan
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+Benchmarks for the background loading pipeline.
+'''
+import os
+import struct
+import time
+
+from parse_bg import parse_bg
+
+def timeit(func, repeat):
+    '''
+    Best wall-clock time of repeat calls to func, in seconds.
+    '''
+    best = None
+    for x in range(0, repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def concatenate_primitives_bytes(bgdata, restart_mode):
+    '''
+    The original concatenate_primitives, which joins the face lists of
+    bgdata parsed without as_numpy as bytes. Kept as a baseline.
+    '''
+    from mesh_ops import PRIMITIVE_RESTART_NONE
+    from parse_bg import PRIM_TRIANGLES, PRIM_TRIANGLE_STRIP
+    PRIMITIVE_RESTART = struct.pack('<H',65535)
+    bgdata_new = []
+    for numverts,vertsize,vertdata,facelists in bgdata:
+        triangles = []
+        triangle_strip = []
+
+        for typ, count, facedata in facelists:
+            assert(len(facedata) == 2*count)
+            if typ == PRIM_TRIANGLE_STRIP:
+                if triangle_strip:
+                    if restart_mode == PRIMITIVE_RESTART_NONE:
+                        # create two degenerate triangles in between
+                        triangle_strip.append(
+                                bytes(triangle_strip[-1][-2:]) +
+                                bytes(facedata[:2]))
+                    else:
+                        triangle_strip.append(PRIMITIVE_RESTART)
+                triangle_strip.append(facedata)
+            elif typ == PRIM_TRIANGLES:
+                triangles.append(facedata)
+            else:
+                raise ValueError(f'Unknown primitive type {typ}')
+
+        facelists_new = []
+        if triangle_strip:
+            joined = b''.join(triangle_strip)
+            facelists_new.append((PRIM_TRIANGLE_STRIP, len(joined)//2, joined))
+        if triangles:
+            joined = b''.join(triangles)
+            facelists_new.append((PRIM_TRIANGLES, len(joined)//2, joined))
+
+        bgdata_new.append((numverts,vertsize,vertdata,facelists_new))
+
+    return bgdata_new
+
+def build_buffers_bytes(bgdata):
+    '''
+    The original buffer building of create_vbos, without the upload: join
+    the vertex and face data of bytes bgdata. Kept as a baseline.
+    '''
+    allvertdata = []
+    allfacedata = []
+    vertdata_ptr = 0
+    facedata_ptr = 0
+    nbgdata = []
+    for numverts,vertsize,vertdata,facelists in bgdata:
+        vertdata_offset = vertdata_ptr
+        allvertdata.append(vertdata)
+        vertdata_ptr += len(vertdata)
+        nfacelists = []
+        for typ, count, facedata in facelists:
+            facedata_offset = facedata_ptr
+            allfacedata.append(facedata)
+            facedata_ptr += len(facedata)
+            nfacelists.append((typ, count, facedata_offset))
+        nbgdata.append((numverts, vertsize, vertdata_offset, nfacelists))
+
+    allvertdata = b''.join(allvertdata)
+    allfacedata = b''.join(allfacedata)
+    return (allvertdata, allfacedata, nbgdata)
+
+def bench_parse_threads(filename, repeat):
+    '''
+    parse_bg decoding time by number of threads.
+    '''
+    base = timeit(lambda: parse_bg(filename, as_numpy=True), repeat)
+    print(f'{"serial":>8s} {base*1000.0:8.2f} ms')
+    threads = 1
+    while threads <= (os.cpu_count() or 1):
+        t = timeit(lambda: parse_bg(filename, as_numpy=True, threads=threads), repeat)
+        print(f'{threads:>8d} {t*1000.0:8.2f} ms  x{base/t:.2f}')
+        threads *= 2
+
+def bench_strip_to_list(filename, repeat):
+    '''
+    Joining strips with primitive restart or degenerate triangles (the
+    original bytes implementation), against converting them to triangle
+    lists, and against joining them with the NumPy port.
+    '''
+    from mesh_ops import PRIMITIVE_RESTART_CORE, PRIMITIVE_RESTART_NONE, concatenate_primitives, triangulate
+    bgdata_bytes = parse_bg(filename)
+    bgdata = parse_bg(filename, as_numpy=True)
+    variants = [
+        ('restart', lambda: concatenate_primitives_bytes(bgdata_bytes, PRIMITIVE_RESTART_CORE)),
+        ('degenerate', lambda: concatenate_primitives_bytes(bgdata_bytes, PRIMITIVE_RESTART_NONE)),
+        ('lists', lambda: triangulate(bgdata)),
+        ('np-restart', lambda: concatenate_primitives(bgdata, PRIMITIVE_RESTART_CORE)),
+        ('np-degen', lambda: concatenate_primitives(bgdata, PRIMITIVE_RESTART_NONE)),
+    ]
+    for name, func in variants:
+        t = timeit(func, repeat)
+        indices = sum(count for numverts,vertsize,vertdata,facelists in func() for typ, count, facedata in facelists)
+        print(f'{name:>10s} {t*1000.0:8.2f} ms {indices:>9d} indices')
+
+def peak_memory(func):
+    '''
+    Peak memory allocated by a call to func, in bytes.
+    '''
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def bench_build_buffers(filename, repeat):
+    '''
+    Building the render-ready buffers from a parsed background, by joining
+    the face lists first and then the buffers as bytes (the original
+    implementation), against building them in one pass into preallocated
+    buffers. Also from file to buffers.
+    '''
+    from mesh_ops import PRIMITIVE_RESTART_CORE, build_buffers
+    mode = PRIMITIVE_RESTART_CORE
+    bgdata_bytes = parse_bg(filename, use_mmap=True)
+    bgdata = parse_bg(filename, use_mmap=True, as_numpy=True)
+    variants = [
+        ('joined', lambda: build_buffers_bytes(concatenate_primitives_bytes(bgdata_bytes, mode))),
+        ('prealloc', lambda: build_buffers(bgdata, mode)),
+        ('load', lambda: build_buffers(parse_bg(filename, use_mmap=True, as_numpy=True), mode)),
+    ]
+    for name, func in variants:
+        t = timeit(func, repeat)
+        peak = peak_memory(func)
+        print(f'{name:>10s} {t*1000.0:8.2f} ms {peak/1e6:8.2f} MB peak')
+
+BENCHMARKS = {
+    'parse-threads': bench_parse_threads,
+    'strip-to-list': bench_strip_to_list,
+    'build-buffers': bench_build_buffers,
+}
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Homeworld 2 background loading benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS), help='Benchmark to run')
+    parser.add_argument('filename', metavar='FILENAME.HOD', help='Name of background mesh')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of runs, the best is reported')
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args.filename, args.repeat)
+
+if __name__ == '__main__':
+    main()
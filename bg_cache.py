@@ -0,0 +1,186 @@
+# Copyright (c) 2014 Wladimir J. van der Laan
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+Render-ready background cache (.hwbg). A cache file holds the concatenated
+vertex buffer, the index buffer and the draw table of a background, so that
+a viewer can map it and upload it without parsing the HOD file.
+
+Layout: a fixed header, followed by the vertex buffer, the index buffer and
+the draw table (JSON), each aligned to 16 bytes.
+'''
+import hashlib
+import json
+import mmap
+import os
+import struct
+import zlib
+
+from big_archive import read_big_path, split_big_path
+
+HWBG_MAGIC = b'HWBG'
+# Bump when the layout of the cache or of the draw table changes
+HWBG_VERSION = 2
+# magic, version, restart mode, source size, source mtime, source sha256,
+# vertex buffer offset and size, index buffer offset and size, draw table
+# offset and size, crc32 of everything after the header
+HEADER_FORMAT = '<4sIIQQ32sQQQQQQI'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# offset and format of source size and mtime in the header
+STAT_OFFSET = struct.calcsize('<4sII')
+STAT_FORMAT = '<QQ'
+ALIGN = 16
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'hw2view')
+
+def cache_path(filename, suffix='.hwbg'):
+    '''
+    Cache file name for a background, unique per absolute source path.
+    '''
+    archive, member = split_big_path(filename)
+    if archive is not None:
+        filename = os.path.abspath(archive) + ':' + member
+    else:
+        filename = os.path.abspath(filename)
+    key = hashlib.sha1(filename.encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+    base = os.path.splitext(os.path.basename(filename.replace('\\', '/')))[0]
+    return os.path.join(cache_dir(), f'{base}-{key}{suffix}')
+
+def options_suffix(cleanup=False, max_triangles=None, merge=False, triangle_lists=False,
+                   rebased=False, optimize=False, encoding='file'):
+    '''
+    Suffix of the cache file for a background built with the given mesh
+    processing options, shared by the viewer and bake.py.
+    '''
+    parts = []
+    if cleanup:
+        parts.append('clean')
+    if max_triangles is not None:
+        parts.append(f'lod{max_triangles}')
+    if merge:
+        parts.append('merged')
+    if triangle_lists:
+        parts.append('lists')
+    if rebased:
+        parts.append('rebased')
+    if optimize:
+        parts.append('opt')
+    if encoding != 'file':
+        parts.append(encoding)
+    return ''.join('.' + part for part in parts) + '.hwbg'
+
+def source_stat(filename):
+    '''
+    (size, mtime_ns) of a background file, or of the archive it is in.
+    '''
+    archive, member = split_big_path(filename)
+    st = os.stat(archive if archive is not None else filename)
+    return (st.st_size, st.st_mtime_ns)
+
+def source_hash(filename):
+    data = read_big_path(filename)
+    if data is None:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    return hashlib.sha256(data).digest()
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+def save_cache(cachefile, filename, restart_mode, vertdata, facedata, nbgdata, digest=None):
+    '''
+    Write the buffers and draw table of a background to a cache file.
+    '''
+    size, mtime_ns = source_stat(filename)
+    if digest is None:
+        digest = source_hash(filename)
+    table = json.dumps(nbgdata, separators=(',', ':')).encode()
+    # buffers may be bytes, memoryviews or NumPy arrays
+    vertdata = memoryview(vertdata).cast('B')
+    facedata = memoryview(facedata).cast('B')
+    vert_ofs = _align(HEADER_SIZE)
+    idx_ofs = _align(vert_ofs + len(vertdata))
+    table_ofs = _align(idx_ofs + len(facedata))
+    body = bytearray(table_ofs + len(table) - HEADER_SIZE)
+    body[vert_ofs-HEADER_SIZE:vert_ofs-HEADER_SIZE+len(vertdata)] = vertdata
+    body[idx_ofs-HEADER_SIZE:idx_ofs-HEADER_SIZE+len(facedata)] = facedata
+    body[table_ofs-HEADER_SIZE:] = table
+    header = struct.pack(HEADER_FORMAT, HWBG_MAGIC, HWBG_VERSION, restart_mode,
+            size, mtime_ns, digest, vert_ofs, len(vertdata), idx_ofs, len(facedata),
+            table_ofs, len(table), zlib.crc32(body))
+
+    os.makedirs(os.path.dirname(cachefile) or '.', exist_ok=True)
+    tmpname = cachefile + '.tmp'
+    with open(tmpname, 'wb') as f:
+        f.write(header)
+        f.write(body)
+    os.replace(tmpname, cachefile)
+
+def update_stat(cachefile, stat):
+    '''
+    Rewrite the source size and mtime in the header of a cache file.
+    '''
+    try:
+        with open(cachefile, 'r+b') as f:
+            f.seek(STAT_OFFSET)
+            f.write(struct.pack(STAT_FORMAT, *stat))
+    except OSError:
+        pass # read-only cache, hash again next time
+
+def cache_digest(cachefile, restart_mode):
+    '''
+    Content hash of the source recorded in the header of a cache file, or
+    None if the cache is missing, of another version or built for another
+    restart mode. The body is not verified.
+    '''
+    try:
+        with open(cachefile, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+    except OSError:
+        return None
+    if len(header) < HEADER_SIZE:
+        return None
+    magic, version, mode, size, mtime_ns, digest = struct.unpack_from(HEADER_FORMAT, header, 0)[:6]
+    if magic != HWBG_MAGIC or version != HWBG_VERSION or mode != restart_mode:
+        return None
+    return digest
+
+def load_cache(cachefile, filename, restart_mode):
+    '''
+    Map a cache file and return (vertdata, facedata, nbgdata), with the
+    buffers as views on the mapping. Returns None if the cache is missing,
+    corrupt, built for another restart mode, or older than the source.
+    '''
+    try:
+        with open(cachefile, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(data) < HEADER_SIZE:
+        return None
+    (magic, version, mode, size, mtime_ns, digest, vert_ofs, vert_size, idx_ofs, idx_size,
+            table_ofs, table_size, crc) = struct.unpack_from(HEADER_FORMAT, data, 0)
+    if magic != HWBG_MAGIC or version != HWBG_VERSION or mode != restart_mode:
+        return None
+    if (vert_ofs + vert_size > len(data) or idx_ofs + idx_size > len(data) or
+            table_ofs + table_size != len(data)):
+        return None
+    try:
+        stat = source_stat(filename)
+        if (size, mtime_ns) != stat:
+            if digest != source_hash(filename):
+                return None
+            # same content, remember the new stat so it is not hashed again
+            update_stat(cachefile, stat)
+    except (OSError, KeyError, ValueError):
+        return None
+    view = memoryview(data)
+    if zlib.crc32(view[HEADER_SIZE:]) != crc:
+        return None
+    try:
+        nbgdata = json.loads(bytes(view[table_ofs:table_ofs+table_size]))
+    except ValueError:
+        return None
+    return (view[vert_ofs:vert_ofs+vert_size], view[idx_ofs:idx_ofs+idx_size], nbgdata)
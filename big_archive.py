@@ -0,0 +1,301 @@
+#!/usr/bin/python3
+# Copyright (c) 2014 Wladimir J. van der Laan
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+Read files directly from Homeworld 2 .big archives.
+The format is described in doc/big_file_format.html.
+'''
+from concurrent.futures import ProcessPoolExecutor
+import fnmatch
+import io
+import mmap
+import numpy
+import os
+import re
+import struct
+import time
+import zlib
+
+from lrucache import LRUCache
+
+ARCHIVE_MAGIC = b'_ARCHIVE'
+ARCHIVE_HEADER_SIZE = 180
+SECTION_HEADER_SIZE = 24
+FILE_HEADER_SIZE = 264 # file name, modification time, CRC
+
+# Flags in the file info list
+FLAG_COMPRESSED_STREAM = 0x10 # decompress during read, used for large files
+FLAG_COMPRESSED_BLOCK = 0x20 # decompress all at once, used for small files
+
+TOC_FORMAT = '<64s64sHHHHH'
+FOLDER_DTYPE = numpy.dtype([
+    ('name_ofs', '<u4'),
+    ('first_subfolder', '<u2'), ('last_subfolder', '<u2'),
+    ('first_file', '<u2'), ('last_file', '<u2')])
+FILE_DTYPE = numpy.dtype([
+    ('name_ofs', '<u4'), ('flags', 'u1'), ('data_ofs', '<u4'),
+    ('compressed_len', '<u4'), ('decompressed_len', '<u4')])
+
+# Default size limit of the decompressed entry cache, in bytes
+DEFAULT_CACHE_SIZE = 64*1024*1024
+
+BIG_PATH_RE = re.compile(r'^(.*?\.big):(.+)$', re.IGNORECASE)
+
+def split_big_path(path):
+    '''
+    Split a path of the form "Homeworld2.big:background/m05.hod" into the
+    archive and member names. Returns (None, path) for plain file names.
+    '''
+    m = BIG_PATH_RE.match(path)
+    if m is None:
+        return (None, path)
+    return (m.group(1), m.group(2))
+
+def normalize_name(name):
+    return name.replace('\\', '/').strip('/').lower()
+
+class _EntryReader(io.RawIOBase):
+    '''
+    Stream that decompresses an archive entry while it is being read.
+    '''
+    def __init__(self, data):
+        self.data = data
+        self.ofs = 0
+        self.decompressor = zlib.decompressobj()
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.pending and not self.decompressor.eof and self.ofs < len(self.data):
+            chunk = self.data[self.ofs:self.ofs+65536]
+            self.ofs += len(chunk)
+            self.pending = self.decompressor.decompress(chunk)
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+class BigArchive(object):
+    def __init__(self, filename, cache_size=DEFAULT_CACHE_SIZE):
+        self.filename = filename
+        self.cache = LRUCache(cache_size)
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._parse_headers()
+
+    def _parse_headers(self):
+        data = self.data
+        if len(data) < ARCHIVE_HEADER_SIZE + SECTION_HEADER_SIZE or data[0:8] != ARCHIVE_MAGIC:
+            raise ValueError(f'{self.filename} is not a .big archive')
+        self.data_offset, = struct.unpack_from('<I', data, 176)
+        base = ARCHIVE_HEADER_SIZE
+        (toc_ofs, toc_count, folder_ofs, folder_count, file_ofs, file_count,
+            names_ofs, names_count) = struct.unpack_from('<IHIHIHIH', data, base)
+        self.tocs = [struct.unpack_from(TOC_FORMAT, data, base + toc_ofs + i*struct.calcsize(TOC_FORMAT))
+                for i in range(toc_count)]
+        self.folders = numpy.frombuffer(data, FOLDER_DTYPE, folder_count, base + folder_ofs)
+        self.files = numpy.frombuffer(data, FILE_DTYPE, file_count, base + file_ofs)
+        self._names_ofs = base + names_ofs
+
+        # hash index from normalized full path to file index
+        self.index = {}
+        for folder in self.folders:
+            dirname = normalize_name(self._name(folder['name_ofs']))
+            for i in range(folder['first_file'], folder['last_file']):
+                name = normalize_name(self._name(self.files[i]['name_ofs']))
+                self.index[f'{dirname}/{name}' if dirname else name] = i
+
+    def _name(self, ofs):
+        start = self._names_ofs + int(ofs)
+        end = self.data.find(b'\0', start)
+        return self.data[start:end].decode('latin-1')
+
+    def names(self):
+        return list(self.index)
+
+    def lookup(self, name):
+        try:
+            return self.index[normalize_name(name)]
+        except KeyError:
+            raise KeyError(f'{name} not found in {self.filename}') from None
+
+    def raw_data(self, i):
+        '''
+        Stored (possibly compressed) data of entry i, as a view on the archive.
+        '''
+        entry = self.files[i]
+        start = self.data_offset + int(entry['data_ofs'])
+        return memoryview(self.data)[start:start+int(entry['compressed_len'])]
+
+    def mtime(self, i):
+        '''
+        Modification time of entry i from the header preceding its data.
+        '''
+        ofs = self.data_offset + int(self.files[i]['data_ofs']) - FILE_HEADER_SIZE + 256
+        return struct.unpack_from('<I', self.data, ofs)[0]
+
+    def match(self, pattern):
+        '''
+        Names and indices of the entries matching a glob pattern.
+        '''
+        pattern = normalize_name(pattern)
+        return [(name, i) for name, i in self.index.items() if fnmatch.fnmatchcase(name, pattern)]
+
+    def decompress(self, i):
+        entry = self.files[i]
+        raw = self.raw_data(i)
+        if not entry['flags'] & (FLAG_COMPRESSED_STREAM | FLAG_COMPRESSED_BLOCK):
+            return raw
+        data = zlib.decompress(raw)
+        if len(data) != entry['decompressed_len']:
+            raise ValueError(f'Entry {i} of {self.filename} decompressed to wrong size')
+        return data
+
+    def read(self, name):
+        '''
+        Contents of a file in the archive. Uncompressed entries are returned
+        as views on the archive, compressed entries are decompressed and kept
+        in an LRU cache of at most cache_size bytes.
+        '''
+        i = self.lookup(name)
+        data = self.cache.get(i)
+        if data is None:
+            data = self.decompress(i)
+            if isinstance(data, bytes):
+                self.cache.put(i, data, len(data))
+        return data
+
+    def open(self, name):
+        '''
+        Open a file in the archive as a binary stream. Compressed entries are
+        decompressed incrementally as the stream is read.
+        '''
+        i = self.lookup(name)
+        if i in self.cache or not self.files[i]['flags'] & (FLAG_COMPRESSED_STREAM | FLAG_COMPRESSED_BLOCK):
+            return io.BytesIO(self.read(name))
+        return io.BufferedReader(_EntryReader(self.raw_data(i)))
+
+_archives = {}
+
+def open_archive(filename):
+    '''
+    Open an archive, reusing an already opened instance.
+    '''
+    archive = _archives.get(filename)
+    if archive is None:
+        archive = _archives[filename] = BigArchive(filename)
+    return archive
+
+def read_big_path(path):
+    '''
+    Read "archive.big:member" paths through the archive. Returns None for
+    plain file names.
+    '''
+    archive, member = split_big_path(path)
+    if archive is None:
+        return None
+    return open_archive(archive).read(member)
+
+def _extract_entries(filename, entries):
+    '''
+    Worker: decompress and write a batch of (index, output path) entries of
+    an archive. Returns the number of bytes written.
+    '''
+    archive = open_archive(filename)
+    written = 0
+    for i, outname in entries:
+        data = archive.decompress(i)
+        os.makedirs(os.path.dirname(outname), exist_ok=True)
+        tmpname = outname + '.tmp'
+        with open(tmpname, 'wb', buffering=0) as f:
+            f.write(data) # one large sequential write
+        mtime = archive.mtime(i)
+        os.utime(tmpname, (mtime, mtime))
+        os.replace(tmpname, outname)
+        written += len(data)
+    return written
+
+def extract(archives, outdir, patterns=('*',), jobs=None, batch_bytes=16*1024*1024):
+    '''
+    Extract the entries matching any of the glob patterns from a number of
+    archives into outdir, decompressing on a process pool. When a name occurs
+    in several archives the last one wins. Outputs with the same size and
+    modification time as the entry are skipped. Raises ValueError, before
+    anything is written, if an entry name points outside of outdir. Returns
+    (number of files written, bytes written, number of files skipped).
+    '''
+    selected = {}
+    for filename in archives:
+        archive = open_archive(filename)
+        for pattern in patterns:
+            for name, i in archive.match(pattern):
+                selected[name] = (filename, i)
+
+    # names come from the archive, don't let them escape outdir with .. or
+    # through symlinks
+    root = os.path.realpath(outdir)
+    outnames = {}
+    for name, (filename, i) in selected.items():
+        outname = os.path.normpath(os.path.join(outdir, *name.split('/')))
+        realname = os.path.realpath(outname)
+        if realname == root or os.path.commonpath([root, realname]) != root:
+            raise ValueError(f'Entry {name} of {filename} is outside of {outdir}')
+        outnames[name] = outname
+
+    # group work per archive into batches of roughly batch_bytes
+    batches = []
+    skipped = 0
+    current = {}
+    for name, (filename, i) in sorted(selected.items()):
+        archive = open_archive(filename)
+        outname = outnames[name]
+        size = int(archive.files[i]['decompressed_len'])
+        try:
+            st = os.stat(outname)
+            if st.st_size == size and int(st.st_mtime) == archive.mtime(i):
+                skipped += 1
+                continue
+        except OSError:
+            pass
+        batch = current.setdefault(filename, [[], 0])
+        batch[0].append((i, outname))
+        batch[1] += size
+        if batch[1] >= batch_bytes:
+            batches.append((filename, batch[0]))
+            del current[filename]
+    batches += [(filename, batch[0]) for filename, batch in current.items()]
+
+    with ProcessPoolExecutor(jobs) as pool:
+        written = sum(pool.map(_extract_entries, *zip(*batches))) if batches else 0
+    return (sum(len(entries) for _, entries in batches), written, skipped)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Homeworld 2 .big archive reader')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    list_parser = subparsers.add_parser('list', help='List archive contents')
+    list_parser.add_argument('archive', metavar='ARCHIVE.BIG', help='Name of archive')
+    extract_parser = subparsers.add_parser('extract', help='Extract files from archives')
+    extract_parser.add_argument('archives', metavar='ARCHIVE.BIG', nargs='+', help='Names of archives, later ones take precedence')
+    extract_parser.add_argument('-o', '--outdir', default='.', help='Output directory')
+    extract_parser.add_argument('-p', '--pattern', action='append', help='Glob pattern of files to extract, for example background/*.hod (can be repeated)')
+    extract_parser.add_argument('-j', '--jobs', type=int, help='Number of worker processes')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        archive = BigArchive(args.archive)
+        for name, i in sorted(archive.index.items()):
+            entry = archive.files[i]
+            print(f'{entry["decompressed_len"]:>10d} {entry["compressed_len"]:>10d} {name}')
+    elif args.command == 'extract':
+        start = time.perf_counter()
+        count, written, skipped = extract(args.archives, args.outdir, args.pattern or ['*'], args.jobs)
+        elapsed = time.perf_counter() - start
+        print(f'Extracted {count} files ({written/1e6:.1f} MB) in {elapsed:.2f} s, '
+              f'{written/1e6/elapsed:.1f} MB/s; {skipped} up to date')
+
+if __name__ == '__main__':
+    main()
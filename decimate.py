@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+# Copyright (c) 2014 Wladimir J. van der Laan
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+Decimation of backgrounds with quadric error metrics over position and
+vertex color (Garland and Heckbert 1998), producing levels of detail for
+low-end hardware.
+
+Vertices are collapsed onto one of their neighbours, never moved, so they
+stay on the sphere with their original colors and every level of detail
+can share the original vertex buffer. Collapses are done in vectorized
+passes over independent sets of vertices. Submesh boundaries are locked so
+that no cracks open between submeshes.
+'''
+import numpy
+
+from mesh_ops import facelists_to_triangles, index_dtype, vertex_colors
+from parse_bg import PRIM_TRIANGLES
+
+# Weight of color (RGB in [0, 1]) relative to position on the unit sphere in
+# the error metric. With the default field of view at 720p a pixel is about
+# 0.001 radians, and 0.25 makes one 8-bit color step cost about as much.
+COLOR_WEIGHT = 0.25
+# Quadrics are evaluated in batches of this many edges to bound memory use
+BATCH = 65536
+
+def attribute_vectors(vertdata):
+    '''
+    Per-vertex points in the space the error is measured in: unit direction
+    and weighted color.
+    '''
+    position = vertdata['position'][:, :3].astype(numpy.float64)
+    radius = numpy.linalg.norm(position, axis=1, keepdims=True)
+    direction = position / numpy.where(radius > 0.0, radius, 1.0)
+    if 'color' in vertdata.dtype.names:
+        color = vertex_colors(vertdata).astype(numpy.float64) * COLOR_WEIGHT
+    else:
+        color = numpy.zeros((len(vertdata), 3))
+    return numpy.concatenate((direction, color), axis=1)
+
+def face_quadrics(points, tris):
+    '''
+    Area-weighted quadrics of triangles in attribute space, as (m, 7, 7)
+    homogeneous matrices K with error [x 1] K [x 1]^T.
+    '''
+    p, q, r = points[tris[:, 0]], points[tris[:, 1]], points[tris[:, 2]]
+    e1 = q - p
+    len1 = numpy.linalg.norm(e1, axis=1, keepdims=True)
+    e1 /= numpy.where(len1 > 0.0, len1, 1.0)
+    e2 = r - p
+    e2 -= (e2 * e1).sum(axis=1, keepdims=True) * e1
+    len2 = numpy.linalg.norm(e2, axis=1, keepdims=True)
+    e2 /= numpy.where(len2 > 0.0, len2, 1.0)
+    area = 0.5 * numpy.linalg.norm(numpy.cross(q[:, :3] - p[:, :3], r[:, :3] - p[:, :3]), axis=1)
+
+    n = points.shape[1]
+    pe1 = (p * e1).sum(axis=1, keepdims=True)
+    pe2 = (p * e2).sum(axis=1, keepdims=True)
+    K = numpy.zeros((len(tris), n + 1, n + 1))
+    K[:, :n, :n] = numpy.eye(n) - e1[:, :, None] * e1[:, None, :] - e2[:, :, None] * e2[:, None, :]
+    b = pe1 * e1 + pe2 * e2 - p
+    K[:, :n, n] = b
+    K[:, n, :n] = b
+    K[:, n, n] = (p * p).sum(axis=1) - pe1[:, 0]**2 - pe2[:, 0]**2
+    return K * area[:, None, None]
+
+def quadric_error(K, points):
+    '''
+    Error of quadrics K (e, 7, 7) at points (e, 6).
+    '''
+    h = numpy.concatenate((points, numpy.ones((len(points), 1))), axis=1)
+    return numpy.maximum(numpy.einsum('ei,eij,ej->e', h, K, h), 0.0)
+
+def edge_table(tris):
+    '''
+    Unique undirected edges of a triangle array and the number of triangles
+    using each.
+    '''
+    edges = numpy.sort(tris[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1).astype(numpy.int64)
+    keys, counts = numpy.unique(edges[:, 0] << 32 | edges[:, 1], return_counts=True)
+    return (numpy.stack((keys >> 32, keys & 0xffffffff), axis=1), counts)
+
+def orientation(positions, tris):
+    p, q, r = positions[tris[:, 0]], positions[tris[:, 1]], positions[tris[:, 2]]
+    return (numpy.cross(p, q) * r).sum(axis=1)
+
+class Decimator(object):
+    '''
+    Incremental decimation of one submesh. Call collapse() repeatedly with
+    decreasing budgets or increasing thresholds to produce a chain.
+    '''
+    def __init__(self, vertdata, tris):
+        self.numverts = len(vertdata)
+        self.positions = vertdata['position'][:, :3].astype(numpy.float64)
+        self.points = attribute_vectors(vertdata)
+        self.tris = tris.astype(numpy.int64)
+        K = face_quadrics(self.points, self.tris)
+        self.quadrics = numpy.zeros((self.numverts,) + K.shape[1:])
+        for i in range(3):
+            numpy.add.at(self.quadrics, self.tris[:, i], K)
+        self.error = 0.0
+
+        # lock vertices on boundaries and non-manifold edges
+        edges, counts = edge_table(self.tris)
+        self.locked = numpy.zeros(self.numverts, dtype=bool)
+        self.locked[edges[counts != 2].reshape(-1)] = True
+        # directed edges (u << 32 | v) whose collapse was rejected
+        self.rejected = numpy.zeros(0, dtype=numpy.int64)
+
+    def _best_collapses(self, edges):
+        '''
+        Cheapest collapse u -> v per vertex u. Returns (cost, target) arrays
+        with infinite cost for vertices that cannot collapse.
+        '''
+        directed = numpy.concatenate((edges, edges[:, ::-1]))
+        directed = directed[~self.locked[directed[:, 0]]]
+        if len(self.rejected):
+            directed = directed[~numpy.isin(directed[:, 0] << 32 | directed[:, 1], self.rejected)]
+        cost = numpy.empty(len(directed))
+        for start in range(0, len(directed), BATCH):
+            u, v = directed[start:start+BATCH].T
+            cost[start:start+BATCH] = quadric_error(self.quadrics[u] + self.quadrics[v], self.points[v])
+        best_cost = numpy.full(self.numverts, numpy.inf)
+        best_target = numpy.full(self.numverts, -1, dtype=numpy.int64)
+        order = numpy.lexsort((cost, directed[:, 0]))
+        first = numpy.ones(len(order), dtype=bool)
+        first[1:] = directed[order[1:], 0] != directed[order[:-1], 0]
+        sel = order[first]
+        best_cost[directed[sel, 0]] = cost[sel]
+        best_target[directed[sel, 0]] = directed[sel, 1]
+        return (best_cost, best_target)
+
+    def _independent(self, edges, cost, target):
+        '''
+        Vertices whose collapse cost is the lowest among their neighbours.
+        Of two such vertices where one is adjacent to the other's target only
+        the cheaper one is kept. The remaining collapses touch disjoint sets
+        of triangles and do not change each other's neighbourhoods, so they
+        can be checked and applied together.
+        '''
+        none = len(cost)
+        rank = numpy.full(self.numverts, none, dtype=numpy.int64)
+        finite = numpy.isfinite(cost)
+        order = numpy.argsort(cost[finite], kind='stable')
+        rank[numpy.nonzero(finite)[0][order]] = numpy.arange(len(order))
+        low = rank.copy()
+        numpy.minimum.at(low, edges[:, 0], rank[edges[:, 1]])
+        numpy.minimum.at(low, edges[:, 1], rank[edges[:, 0]])
+        cand = numpy.nonzero(finite & (low == rank))[0]
+        # lowest rank of the candidates collapsing onto each vertex, and of
+        # those adjacent to each vertex
+        onto = numpy.full(self.numverts, none, dtype=numpy.int64)
+        numpy.minimum.at(onto, target[cand], rank[cand])
+        cand_rank = numpy.full(self.numverts, none, dtype=numpy.int64)
+        cand_rank[cand] = rank[cand]
+        near = cand_rank.copy()
+        near_onto = onto.copy()
+        numpy.minimum.at(near, edges[:, 0], cand_rank[edges[:, 1]])
+        numpy.minimum.at(near, edges[:, 1], cand_rank[edges[:, 0]])
+        numpy.minimum.at(near_onto, edges[:, 0], onto[edges[:, 1]])
+        numpy.minimum.at(near_onto, edges[:, 1], onto[edges[:, 0]])
+        keep = (rank[cand] <= near[target[cand]]) & (rank[cand] <= near_onto[cand])
+        return cand[keep]
+
+    def _link_ok(self, edges, counts, candidates, targets):
+        '''
+        Link condition: u and v share no neighbours other than the vertices
+        opposite to edge (u, v), so that the collapse keeps the mesh manifold.
+        '''
+        both = numpy.concatenate((edges, edges[:, ::-1]))
+        order = numpy.argsort(both[:, 0], kind='stable')
+        nbr = both[order, 1]
+        offsets = numpy.searchsorted(both[order, 0], numpy.arange(self.numverts + 1))
+        keys = edges[:, 0] << 32 | edges[:, 1]
+        wanted = numpy.minimum(candidates, targets) << 32 | numpy.maximum(candidates, targets)
+        opposite = counts[numpy.searchsorted(keys, wanted)].tolist()
+        ok = numpy.zeros(len(candidates), dtype=bool)
+        for i, (u, v) in enumerate(zip(candidates.tolist(), targets.tolist())):
+            common = set(nbr[offsets[u]:offsets[u+1]].tolist()) & set(nbr[offsets[v]:offsets[v+1]].tolist())
+            ok[i] = len(common) == opposite[i]
+        return ok
+
+    def collapse(self, max_triangles=0, max_error=numpy.inf):
+        '''
+        Collapse edges until the submesh has at most max_triangles triangles
+        or no collapse with error up to max_error (square root of the
+        quadric error) is left. Returns the triangles.
+        '''
+        while len(self.tris) > max_triangles:
+            edges, counts = edge_table(self.tris)
+            cost, target = self._best_collapses(edges)
+            cost[cost > max_error**2] = numpy.inf
+            cand = self._independent(edges, cost, target)
+            if not len(cand):
+                break
+            # each collapse removes about two triangles, do not overshoot
+            excess = max((len(self.tris) - max_triangles + 1) // 2, 1)
+            cand = cand[numpy.argsort(cost[cand], kind='stable')[:excess]]
+            # collapses that break the link condition or flip triangles are
+            # not tried again, the vertex falls back to its next best target
+            link_ok = self._link_ok(edges, counts, cand, target[cand])
+            new_tris, flipped = self._apply(cand[link_ok], target)
+            ok = link_ok & ~numpy.isin(cand, flipped)
+            self.rejected = numpy.concatenate((self.rejected, cand[~ok] << 32 | target[cand[~ok]]))
+            cand = cand[ok]
+            if not len(cand):
+                continue
+            new_tris, flipped = self._apply(cand, target)
+            self.error = max(self.error, float(numpy.sqrt(cost[cand].max())))
+            numpy.add.at(self.quadrics, target[cand], self.quadrics[cand])
+            keep = ((new_tris[:, 0] != new_tris[:, 1]) & (new_tris[:, 1] != new_tris[:, 2]) &
+                    (new_tris[:, 0] != new_tris[:, 2]))
+            self.tris = new_tris[keep]
+        return self.tris
+
+    def _apply(self, cand, target):
+        '''
+        Triangles after collapsing cand onto their targets, and the
+        candidates whose collapse would flip a triangle.
+        '''
+        remap = numpy.arange(self.numverts)
+        remap[cand] = target[cand]
+        new_tris = remap[self.tris]
+        check = ((new_tris != self.tris).any(axis=1) & (new_tris[:, 0] != new_tris[:, 1]) &
+                 (new_tris[:, 1] != new_tris[:, 2]) & (new_tris[:, 0] != new_tris[:, 2]))
+        before = orientation(self.positions, self.tris[check])
+        after = orientation(self.positions, new_tris[check])
+        bad = self.tris[check][before * after <= 0.0].reshape(-1)
+        return (new_tris, numpy.unique(bad[numpy.isin(bad, cand)]))
+
+def decimate_background(bgdata, max_triangles=None, max_error=None):
+    '''
+    Decimate a parsed background (parse_bg with as_numpy=True) to a total
+    triangle budget, distributed over the submeshes in proportion to their
+    size, or to an error threshold. Each submesh becomes one triangle list
+    that indexes the original vertices.
+    '''
+    bgdata, error = lod_chain(bgdata, [(max_triangles, max_error)])[0]
+    return bgdata
+
+def lod_chain(bgdata, levels):
+    '''
+    Chain of levels of detail for a parsed background. levels is a list of
+    (max_triangles, max_error) pairs, either of which may be None, in order
+    of decreasing detail. Returns a list of (bgdata, error) per level with
+    the largest error of any collapse made so far.
+    '''
+    tris = [facelists_to_triangles(facelists) for numverts,vertsize,vertdata,facelists in bgdata]
+    total = sum(len(t) for t in tris)
+    decimators = [Decimator(vertdata, t) for (numverts,vertsize,vertdata,facelists), t in zip(bgdata, tris)]
+    chain = []
+    for max_triangles, max_error in levels:
+        bgdata_new = []
+        for (numverts,vertsize,vertdata,facelists), decimator in zip(bgdata, decimators):
+            budget = 0
+            if max_triangles is not None:
+                budget = int(max_triangles * len(decimator.tris) / max(total, 1))
+            elif max_error is None:
+                raise ValueError('Level of detail needs a triangle budget or error threshold')
+            indices = decimator.collapse(budget, numpy.inf if max_error is None else max_error)
+            indices = indices.reshape(-1).astype(index_dtype(numverts))
+            bgdata_new.append((numverts, vertsize, vertdata, [(PRIM_TRIANGLES, len(indices), indices)] if len(indices) else []))
+        total = sum(len(d.tris) for d in decimators)
+        chain.append((bgdata_new, max(d.error for d in decimators)))
+    return chain
+
+def parse_levels(triangles, errors):
+    return [(n, None) for n in triangles or []] + [(None, e) for e in errors or []]
+
+def main():
+    import argparse
+    import time
+    from parse_bg import parse_bg
+    parser = argparse.ArgumentParser(description='Build levels of detail of a background')
+    parser.add_argument('filename', metavar='FILENAME.HOD', help='Name of background mesh')
+    parser.add_argument('-t', '--triangles', type=int, nargs='+', help='Triangle budgets, in decreasing order')
+    parser.add_argument('-e', '--error', type=float, nargs='+', help='Error thresholds, in increasing order')
+    args = parser.parse_args()
+
+    bgdata = parse_bg(args.filename, as_numpy=True)
+    total = sum(len(facelists_to_triangles(facelists)) for numverts,vertsize,vertdata,facelists in bgdata)
+    print(f'LOD 0: {total:>8d} triangles')
+    start = time.perf_counter()
+    chain = lod_chain(bgdata, parse_levels(args.triangles, args.error))
+    elapsed = time.perf_counter() - start
+    for i, (lod, error) in enumerate(chain):
+        count = sum(count for numverts,vertsize,vertdata,facelists in lod for typ, count, facedata in facelists) // 3
+        print(f'LOD {i+1}: {count:>8d} triangles, max error {error:.5f}')
+    print(f'Decimated in {elapsed:.2f} s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+# Copyright (c) 2014 Wladimir J. van der Laan
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+Shadow copy of the GL state that the viewer sets, so that GL calls are only
+issued when a value actually changes, with counters of the calls issued per
+frame. The viewer makes its state changes and buffer uploads through here.
+'''
+from OpenGL.extensions import alternate
+from OpenGL.GL import *
+from OpenGL.GL import shaders
+from OpenGL.GL.NV.primitive_restart import *
+from OpenGL.GL.ARB.vertex_shader import *
+from OpenGL.GL.ARB.vertex_buffer_object import *
+from OpenGL.GL.ARB.vertex_program import *
+import collections
+import ctypes
+
+from math3d import perspective_matrix
+from mesh_ops import PRIMITIVE_RESTART_CORE, PRIMITIVE_RESTART_NV, PRIMITIVE_RESTART_INDICES
+
+# extension alternates for GL <2.0
+glGetAttribLocation = alternate('glGetAttribLocation', glGetAttribLocation, glGetAttribLocationARB)
+glEnableVertexAttribArray = alternate('glEnableVertexAttribArray', glEnableVertexAttribArray, glEnableVertexAttribArrayARB)
+glDisableVertexAttribArray = alternate('glDisableVertexAttribArray', glDisableVertexAttribArray, glDisableVertexAttribArrayARB)
+glVertexAttribPointer = alternate('glVertexAttribPointer', glVertexAttribPointer, glVertexAttribPointerARB)
+glGenBuffers = alternate('glGenBuffers', glGenBuffers, glGenBuffersARB)
+glBindBuffer = alternate('glBindBuffer', glBindBuffer, glBindBufferARB)
+glBufferData = alternate('glBufferData', glBufferData, glBufferDataARB)
+glDeleteBuffers = alternate('glDeleteBuffers', glDeleteBuffers, glDeleteBuffersARB)
+
+class GLState(object):
+    '''
+    State of the current context as last set through this object. Code that
+    changes the same state with direct GL calls must call invalidate().
+    '''
+    def __init__(self):
+        self.values = {}
+        self.calls = collections.Counter() # GL calls in the current frame
+        self.skipped = 0 # calls avoided in the current frame
+        self.last_calls = collections.Counter() # GL calls in the last frame
+        self.last_skipped = 0
+        self.frames = 0
+        self.total_calls = 0
+
+    def invalidate(self):
+        '''
+        Forget all tracked state, the next request for every value issues its
+        GL call.
+        '''
+        self.values = {}
+
+    def end_frame(self):
+        '''
+        Keep the counters of the frame that was just drawn and reset them.
+        '''
+        self.last_calls = self.calls
+        self.last_skipped = self.skipped
+        self.calls = collections.Counter()
+        self.skipped = 0
+        self.frames += 1
+
+    def call(self, func, *args):
+        '''
+        Issue a GL call that is not tracked, such as a draw call.
+        '''
+        self.calls[func.__name__] += 1
+        self.total_calls += 1
+        return func(*args)
+
+    def _set(self, key, value, func, *args):
+        if self.values.get(key) == value:
+            self.skipped += 1
+            return False
+        self.values[key] = value
+        self.call(func, *args)
+        return True
+
+    def viewport(self, width, height):
+        self._set('viewport', (width, height), glViewport, 0, 0, width, height)
+
+    def matrix_mode(self, mode):
+        self._set('matrix_mode', mode, glMatrixMode, mode)
+
+    def projection(self, fovy, aspect, near, far):
+        '''
+        Load a perspective projection; the matrix is only computed when one
+        of the parameters changed.
+        '''
+        value = (fovy, aspect, near, far)
+        if self.values.get('projection') == value:
+            self.skipped += 1
+            return
+        self.matrix_mode(GL_PROJECTION)
+        self.values['projection'] = value
+        self.call(glLoadMatrixf, perspective_matrix(fovy, aspect, near, far))
+
+    def modelview(self, matrix):
+        self.matrix_mode(GL_MODELVIEW)
+        self._set('modelview', matrix.tobytes(), glLoadMatrixf, matrix)
+
+    def polygon_mode(self, mode):
+        self._set('polygon_mode', mode, glPolygonMode, GL_FRONT_AND_BACK, mode)
+
+    def enable(self, cap, enabled=True):
+        self._set(('enable', cap), enabled, glEnable if enabled else glDisable, cap)
+
+    def enable_client_state(self, cap, enabled=True):
+        self._set(('client_state', cap), enabled, glEnableClientState if enabled else glDisableClientState, cap)
+
+    def primitive_restart(self, mode, index_size):
+        '''
+        Enable primitive restart in one of the PRIMITIVE_RESTART_* modes,
+        with the restart index for index_size byte indices. Restart applies
+        to all primitives, so the index is kept out of the range of 32-bit
+        indices by switching it with the index size.
+        '''
+        index = PRIMITIVE_RESTART_INDICES[index_size]
+        if mode == PRIMITIVE_RESTART_CORE:
+            self.enable(GL_PRIMITIVE_RESTART)
+            self._set('restart_index', index, glPrimitiveRestartIndex, index)
+        elif mode == PRIMITIVE_RESTART_NV:
+            self.enable_client_state(GL_PRIMITIVE_RESTART_NV)
+            self._set('restart_index', index, glPrimitiveRestartIndexNV, index)
+
+    def use_program(self, program):
+        self._set('program', program, shaders.glUseProgram, program)
+
+    def bind_buffer(self, target, buf):
+        self._set(('buffer', target), buf, glBindBuffer, target, buf)
+
+    def create_buffer(self, target, data):
+        '''
+        Create a buffer object and upload data (a NumPy array) to it. The
+        buffer stays bound to target.
+        '''
+        buf = self.call(glGenBuffers, 1)
+        self.bind_buffer(target, buf)
+        self.call(glBufferData, target, data.nbytes, data, GL_STATIC_DRAW)
+        return buf
+
+    def delete_buffers(self, buffers):
+        '''
+        Delete buffer objects. GL unbinds them, and their names may be
+        reused, so forget the bindings and attribute pointers that refer to
+        them.
+        '''
+        self.call(glDeleteBuffers, len(buffers), buffers)
+        for key, value in list(self.values.items()):
+            if not isinstance(key, tuple):
+                continue
+            if ((key[0] == 'buffer' and value in buffers) or
+                    (key[0] == 'attrib_pointer' and value[0] in buffers)):
+                del self.values[key]
+
+    def attrib_array(self, loc, enabled=True):
+        self._set(('attrib_array', loc), enabled,
+                  glEnableVertexAttribArray if enabled else glDisableVertexAttribArray, loc)
+
+    def attrib_pointer(self, loc, size, typ, normalized, stride, offset):
+        '''
+        Point an attribute at a byte offset in the bound GL_ARRAY_BUFFER.
+        '''
+        value = (self.values.get(('buffer', GL_ARRAY_BUFFER)), size, typ, normalized, stride, offset)
+        self._set(('attrib_pointer', loc), value, glVertexAttribPointer,
+                  loc, size, typ, normalized, stride, ctypes.c_void_p(offset))
+
+    def attrib_constant(self, loc, x, y, z, w):
+        self._set(('attrib_constant', loc), (x, y, z, w), glVertexAttrib4f, loc, x, y, z, w)
+
+    def frame_report(self):
+        '''
+        One-line summary of the GL calls in the last frame.
+        '''
+        issued = sum(self.last_calls.values())
+        average = self.total_calls / self.frames if self.frames else 0.0
+        return (f'{issued} GL calls in last frame ({self.last_skipped} skipped), '
+                f'{average:.1f} per frame on average over {self.frames} frames')
@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# Copyright (c) 2014 Wladimir J. van der Laan
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+Catalog of HOD collections in a SQLite database, built from the chunk and
+BMSH headers only.
+'''
+import hashlib
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+
+from big_archive import open_archive, split_big_path
+from hod_fsck import find_hods
+from parse_bg import PRIM_TRIANGLES, PRIM_TRIANGLE_STRIP, iter_chunks, vertex_dtype
+
+DEFAULT_DB = 'hod_catalog.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    nummeshes INTEGER NOT NULL,
+    numverts INTEGER NOT NULL,
+    numindices INTEGER NOT NULL,
+    vertbytes INTEGER NOT NULL,
+    indexbytes INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_numverts ON files(numverts);
+CREATE INDEX IF NOT EXISTS files_hash ON files(hash);
+CREATE TABLE IF NOT EXISTS meshes (
+    path TEXT NOT NULL REFERENCES files(path) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    lod INTEGER NOT NULL,
+    nummeshes INTEGER NOT NULL,
+    vertmask INTEGER NOT NULL,
+    numverts INTEGER NOT NULL,
+    vertsize INTEGER NOT NULL,
+    numstrips INTEGER NOT NULL,
+    numlists INTEGER NOT NULL,
+    numindices INTEGER NOT NULL,
+    PRIMARY KEY (path, idx)
+);
+'''
+
+def BMSH_header(data, ofs):
+    '''
+    Read the BMSH header and the face list headers at data[ofs:], skipping
+    over the vertex and index payloads. Returns a row per mesh in the BMSH.
+    '''
+    version, = struct.unpack_from('>I', data, ofs)
+    lod,num = struct.unpack_from('<II', data, ofs+4)
+    pos = ofs + 12
+    rows = []
+    for m in range(0, num):
+        mat,vertmask,numverts = struct.unpack_from('<III', data, pos)
+        vertsize = vertex_dtype(vertmask).itemsize
+        pos += 12 + vertsize * numverts
+        numfacelists, = struct.unpack_from('<H', data, pos)
+        pos += 2
+        numstrips = numlists = numindices = 0
+        for x in range(0, numfacelists):
+            listtype,listcount = struct.unpack_from('<II', data, pos)
+            pos += 8 + 2*listcount
+            numindices += listcount
+            if listtype == PRIM_TRIANGLE_STRIP:
+                numstrips += 1
+            elif listtype == PRIM_TRIANGLES:
+                numlists += 1
+        rows.append((version, lod, num, vertmask, numverts, vertsize, numstrips, numlists, numindices))
+    return rows
+
+def catalog_data(data):
+    '''
+    Per-mesh header rows for a HOD file in data.
+    '''
+    return [row for path, blkid, ofs, size in iter_chunks(data) if blkid == b'BMSH'
+            for row in BMSH_header(data, ofs)]
+
+class Catalog(object):
+    def __init__(self, dbname=DEFAULT_DB):
+        self.db = sqlite3.connect(dbname)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _stat(self, path):
+        '''
+        (size, mtime_ns) of a file or of a file inside a .big archive.
+        '''
+        archive, member = split_big_path(path)
+        if archive is None:
+            st = os.stat(path)
+            return (st.st_size, st.st_mtime_ns)
+        big = open_archive(archive)
+        i = big.lookup(member)
+        return (int(big.files[i]['decompressed_len']), big.mtime(i) * 1000000000)
+
+    def _read(self, path):
+        archive, member = split_big_path(path)
+        if archive is not None:
+            return open_archive(archive).read(member)
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def add(self, path):
+        '''
+        Catalog a file if it is new or changed. Unchanged files (same size and
+        mtime) are not read at all, and files whose content hash did not
+        change are not re-parsed. Returns True if the file was parsed.
+        '''
+        size, mtime_ns = self._stat(path)
+        row = self.db.execute('SELECT size, mtime_ns, hash FROM files WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == size and row[1] == mtime_ns:
+            return False
+        data = self._read(path)
+        digest = hashlib.sha256(data).hexdigest()
+        if row is not None and row[2] == digest:
+            with self.db:
+                self.db.execute('UPDATE files SET size = ?, mtime_ns = ? WHERE path = ?', (size, mtime_ns, path))
+            return False
+        meshes = catalog_data(data)
+        with self.db:
+            self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+            self.db.execute('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                path, size, mtime_ns, digest, len(meshes),
+                sum(m[4] for m in meshes), sum(m[8] for m in meshes),
+                sum(m[4] * m[5] for m in meshes), sum(m[8] * 2 for m in meshes)))
+            self.db.executemany('INSERT INTO meshes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(path, idx) + m for idx, m in enumerate(meshes)])
+        return True
+
+    def scan(self, paths):
+        '''
+        Incrementally catalog HOD files, directories and .big archives, and
+        drop entries for files under the scanned paths that no longer exist.
+        Returns (number of files parsed, number unchanged, number removed).
+        '''
+        # paths are cataloged absolute, so that the same file is one entry
+        # and removal below only matches whole path components
+        paths = [os.path.abspath(p) for p in paths]
+        parsed = unchanged = 0
+        seen = set()
+        for path in expand_paths(paths):
+            seen.add(path)
+            try:
+                if self.add(path):
+                    parsed += 1
+                else:
+                    unchanged += 1
+            except (OSError, KeyError, ValueError, struct.error) as e:
+                print(f'Warning: could not catalog {path}: {e}', file=sys.stderr)
+        removed = 0
+        for path, in self.db.execute('SELECT path FROM files').fetchall():
+            if path not in seen and any(path == p or path.startswith(p.rstrip(os.sep) + os.sep) or
+                                        path.startswith(p + ':') for p in paths):
+                with self.db:
+                    self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+                removed += 1
+        return (parsed, unchanged, removed)
+
+    def query(self, where='1', params=()):
+        '''
+        Rows of the files table matching an SQL condition.
+        '''
+        return self.db.execute(f'SELECT * FROM files WHERE {where} ORDER BY path', params).fetchall()
+
+def expand_paths(paths):
+    '''
+    HOD files named by paths: plain files, directories to scan recursively,
+    and .big archives of which the .hod entries are included.
+    '''
+    for path in paths:
+        if path.lower().endswith('.big') and os.path.isfile(path):
+            for name, i in sorted(open_archive(path).match('*.hod')):
+                yield f'{path}:{name}'
+        else:
+            yield from find_hods([path])
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Homeworld 2 HOD catalog')
+    parser.add_argument('--db', default=DEFAULT_DB, help='Catalog database')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    scan_parser = subparsers.add_parser('scan', help='Add or update files in the catalog')
+    scan_parser.add_argument('paths', metavar='PATH', nargs='+', help='HOD files, directories or .big archives')
+    query_parser = subparsers.add_parser('query', help='List cataloged files')
+    query_parser.add_argument('--max-verts', type=int, help='Only files with fewer vertices')
+    query_parser.add_argument('--where', help='Additional SQL condition on the files table')
+    args = parser.parse_args()
+
+    catalog = Catalog(args.db)
+    if args.command == 'scan':
+        parsed, unchanged, removed = catalog.scan(args.paths)
+        print(f'{parsed} parsed, {unchanged} unchanged, {removed} removed')
+    elif args.command == 'query':
+        where = ['1']
+        params = []
+        if args.max_verts is not None:
+            where.append('numverts < ?')
+            params.append(args.max_verts)
+        if args.where:
+            where.append(f'({args.where})')
+        for row in catalog.query(' AND '.join(where), params):
+            path, size, mtime_ns, digest, nummeshes, numverts, numindices, vertbytes, indexbytes = row
+            print(f'{numverts:>8d} verts {numindices:>8d} indices {nummeshes:>3d} meshes {path}')
+    catalog.close()
+
+if __name__ == '__main__':
+    main()
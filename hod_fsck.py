@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+# Copyright (c) 2014 Wladimir J. van der Laan
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+Verify the structure of HOD files before they are handed to the viewer.
+Prints one JSON report per file.
+'''
+import json
+import mmap
+import numpy
+import os
+import struct
+import sys
+
+from big_archive import read_big_path
+from parse_bg import NESTED, PRIM_TRIANGLES, PRIM_TRIANGLE_STRIP, form_header_size, vertex_dtype
+
+class Report(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.errors = []
+        self.warnings = []
+        self.chunks = 0
+        self.meshes = 0
+
+    def error(self, ofs, message):
+        self.errors.append(f'@{ofs}: {message}')
+
+    def warning(self, ofs, message):
+        self.warnings.append(f'@{ofs}: {message}')
+
+    def as_dict(self):
+        return {
+            'file': self.filename,
+            'ok': not self.errors,
+            'chunks': self.chunks,
+            'meshes': self.meshes,
+            'errors': self.errors,
+            'warnings': self.warnings,
+        }
+
+def check_strips(report, ofs, strip):
+    '''
+    Count degenerate triangles in a strip. Degenerate triangles are used to
+    stitch strips together, but a strip that consists only of them draws
+    nothing.
+    '''
+    a, b, c = strip[:-2], strip[1:-1], strip[2:]
+    degenerate = numpy.count_nonzero((a == b) | (b == c) | (a == c))
+    if degenerate == len(a):
+        report.warning(ofs, f'strip of {len(strip)} indices has only degenerate triangles')
+
+def check_triangles(report, ofs, triangles):
+    tris = triangles.reshape(-1, 3)
+    degenerate = numpy.count_nonzero((tris[:,0] == tris[:,1]) | (tris[:,1] == tris[:,2]) | (tris[:,0] == tris[:,2]))
+    if degenerate:
+        report.warning(ofs, f'{degenerate} of {len(tris)} triangles are degenerate')
+
+def check_BMSH(report, data, ofs, end):
+    '''
+    Check the BMSH payload in data[ofs:end]: header, vertex data and face
+    lists must fit in the chunk, and all indices must refer to vertices.
+    '''
+    if end - ofs < 12:
+        report.error(ofs, 'BMSH header truncated')
+        return
+    lod,num = struct.unpack_from('<II', data, ofs+4)
+    pos = ofs + 12
+    for m in range(0, num):
+        pos = check_mesh(report, data, ofs, pos, end)
+        if pos is None:
+            return
+    if pos != end:
+        report.warning(pos, f'{end - pos} trailing bytes in BMSH')
+
+def check_mesh(report, data, ofs, pos, end):
+    '''
+    Check one of the meshes of the BMSH at ofs, starting at pos. Returns the
+    offset after the mesh, or None if the rest of the BMSH can't be read.
+    '''
+    if end - pos < 12:
+        report.error(ofs, 'BMSH header truncated')
+        return None
+    mat,vertmask,numverts = struct.unpack_from('<III', data, pos)
+    try:
+        vtype = vertex_dtype(vertmask)
+    except ValueError as e:
+        report.error(ofs, str(e))
+        return None
+    pos += 12
+    vertend = pos + vtype.itemsize * numverts
+    if vertend + 2 > end:
+        report.error(ofs, f'vertex data for {numverts} vertices exceeds chunk')
+        return None
+    if 'position' not in vtype.names:
+        report.error(ofs, 'vertex format has no position')
+    else:
+        verts = numpy.frombuffer(data, dtype=vtype, count=numverts, offset=pos)
+        if not numpy.isfinite(verts['position']).all():
+            report.error(ofs, 'non-finite vertex positions')
+    pos = vertend
+    numfacelists, = struct.unpack_from('<H', data, pos)
+    pos += 2
+    for x in range(0, numfacelists):
+        if pos + 8 > end:
+            report.error(pos, f'face list {x} header exceeds chunk')
+            return None
+        listtype,listcount = struct.unpack_from('<II', data, pos)
+        pos += 8
+        if pos + 2*listcount > end:
+            report.error(pos, f'face list {x} of {listcount} indices exceeds chunk')
+            return None
+        indices = numpy.frombuffer(data, dtype='<u2', count=listcount, offset=pos)
+        if listcount and indices.max() >= numverts:
+            report.error(pos, f'face list {x} has index {indices.max()} >= {numverts} vertices')
+        if listtype == PRIM_TRIANGLES:
+            if listcount % 3:
+                report.error(pos, f'triangle list {x} has {listcount} indices, not a multiple of 3')
+            else:
+                check_triangles(report, pos, indices)
+        elif listtype == PRIM_TRIANGLE_STRIP:
+            if listcount < 3:
+                report.error(pos, f'triangle strip {x} has only {listcount} indices')
+            else:
+                check_strips(report, pos, indices)
+        else:
+            report.error(pos, f'face list {x} has unknown primitive type {listtype}')
+        pos += 2*listcount
+    report.meshes += 1
+    return pos
+
+def check_block(report, data, ofs, end):
+    '''
+    Check that the chunks in data[ofs:end] exactly tile their parent.
+    '''
+    while ofs < end:
+        if ofs + 12 > end:
+            report.error(ofs, 'chunk header exceeds parent')
+            return
+        size, = struct.unpack_from('>I', data, ofs+4)
+        blkid = bytes(data[ofs+8:ofs+12])
+        if size < 4:
+            report.error(ofs, f'chunk {blkid!r} has invalid size {size}')
+            return
+        ofs += 12
+        size -= 4
+        if ofs + size > end:
+            report.error(ofs, f'chunk {blkid!r} of {size} bytes exceeds parent by {ofs + size - end} bytes')
+            return
+        report.chunks += 1
+        if blkid in NESTED:
+            try:
+                hdrsize = form_header_size(blkid, data, ofs)
+            except struct.error:
+                hdrsize = size + 1
+            if hdrsize > size:
+                report.error(ofs, f'{blkid!r} header exceeds chunk')
+            else:
+                check_block(report, data, ofs+hdrsize, ofs+size)
+        elif blkid == b'BMSH':
+            check_BMSH(report, data, ofs, ofs+size)
+        ofs += size
+
+def check_file(report, filename):
+    data = read_big_path(filename)
+    if data is not None:
+        check_block(report, data, 0, len(data))
+        return
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            check_block(report, data, 0, len(data))
+
+def check_hod(filename):
+    '''
+    Verify a HOD file, which can be inside a .big archive. Returns a Report.
+    '''
+    report = Report(filename)
+    try:
+        check_file(report, filename)
+    except (OSError, KeyError, ValueError) as e:
+        report.error(0, str(e))
+    if not report.errors and not report.chunks:
+        report.error(0, 'empty file')
+    elif not report.errors and not report.meshes:
+        report.warning(0, 'no BMSH meshes found')
+    return report
+
+def find_hods(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    if name.lower().endswith('.hod'):
+                        yield os.path.join(dirpath, name)
+        else:
+            yield path
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Homeworld 2 HOD verifier')
+    parser.add_argument('paths', metavar='PATH', nargs='+', help='HOD files or directories to scan')
+    args = parser.parse_args()
+
+    failed = 0
+    for filename in find_hods(args.paths):
+        report = check_hod(filename)
+        if report.errors:
+            failed += 1
+        print(json.dumps(report.as_dict()))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
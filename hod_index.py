@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+# Copyright (c) 2014 Wladimir J. van der Laan
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+Table of contents for the chunks in a HOD file, with random access to
+individual BMSH meshes.
+'''
+from collections import namedtuple
+import json
+import mmap
+import os
+import struct
+
+from parse_bg import iter_chunks, parse_BMSH
+
+# Bump when the layout of the sidecar index changes
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.idx'
+
+# lod, nummeshes and numverts (of the first mesh) are only filled in for BMSH chunks
+ChunkEntry = namedtuple('ChunkEntry', ['blkid', 'path', 'offset', 'size', 'lod', 'nummeshes', 'numverts'])
+
+class HODIndex(object):
+    def __init__(self, filename, chunks, file_size, mtime_ns):
+        self.filename = filename
+        self.chunks = chunks
+        self.file_size = file_size
+        self.mtime_ns = mtime_ns
+        self.meshes = [c for c in chunks if c.blkid == 'BMSH']
+
+    @classmethod
+    def build(cls, filename):
+        '''
+        Index a HOD file in one pass over its chunk headers.
+        '''
+        chunks = []
+        with open(filename, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if st.st_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    for path, blkid, offset, size in iter_chunks(data):
+                        lod = nummeshes = numverts = None
+                        if blkid == b'BMSH':
+                            # version, lod and count, then mat, mask and numverts of the first mesh
+                            if size < 12 or offset + 12 > len(data):
+                                raise ValueError(f'Truncated BMSH header at offset {offset}')
+                            lod,nummeshes = struct.unpack_from('<II', data, offset+4)
+                            if nummeshes:
+                                if size < 24 or offset + 24 > len(data):
+                                    raise ValueError(f'Truncated BMSH header at offset {offset}')
+                                numverts, = struct.unpack_from('<I', data, offset+20)
+                        chunks.append(ChunkEntry(blkid.decode('latin-1'),
+                            '/'.join(p.decode('latin-1') for p in path),
+                            offset, size, lod, nummeshes, numverts))
+        return cls(filename, chunks, st.st_size, st.st_mtime_ns)
+
+    @classmethod
+    def load(cls, filename, save=True):
+        '''
+        Load the sidecar index for a HOD file, or build it (and save it, if
+        requested) when it is missing or stale.
+        '''
+        st = os.stat(filename)
+        try:
+            with open(filename + INDEX_SUFFIX, 'r') as f:
+                doc = json.load(f)
+            if (doc['version'] == INDEX_VERSION and doc['size'] == st.st_size and
+                    doc['mtime_ns'] == st.st_mtime_ns):
+                return cls(filename, [ChunkEntry(*c) for c in doc['chunks']],
+                        doc['size'], doc['mtime_ns'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        index = cls.build(filename)
+        if save:
+            index.save()
+        return index
+
+    def save(self):
+        '''
+        Write the index as a sidecar file next to the HOD file.
+        '''
+        doc = {
+            'version': INDEX_VERSION,
+            'size': self.file_size,
+            'mtime_ns': self.mtime_ns,
+            'chunks': [list(c) for c in self.chunks],
+        }
+        tmpname = self.filename + INDEX_SUFFIX + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(doc, f, separators=(',', ':'))
+        os.replace(tmpname, self.filename + INDEX_SUFFIX)
+
+    def load_mesh(self, i, as_numpy=False):
+        '''
+        Read and decode only the i-th BMSH of the file. Returns its meshes,
+        see parse_BMSH.
+        '''
+        entry = self.meshes[i]
+        with open(self.filename, 'rb') as f:
+            f.seek(entry.offset)
+            data = f.read(entry.size)
+        if len(data) != entry.size:
+            raise ValueError('Truncated HOD file')
+        return parse_BMSH(memoryview(data), as_numpy)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Homeworld 2 HOD chunk index')
+    parser.add_argument('filename', metavar='FILENAME.HOD', help='Name of HOD file')
+    parser.add_argument('--no-save', action='store_true', help='Do not write sidecar index')
+    args = parser.parse_args()
+
+    index = HODIndex.load(args.filename, save=not args.no_save)
+    for c in index.chunks:
+        name = f'{c.path}/{c.blkid}' if c.path else c.blkid
+        extra = ''
+        if c.blkid == 'BMSH':
+            extra = f' lod={c.lod} meshes={c.nummeshes} verts={c.numverts}'
+        print(f'{name:20s} ofs={c.offset:<10d} size={c.size:<10d}{extra}')
+
+if __name__ == '__main__':
+    main()
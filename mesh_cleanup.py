@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+# Copyright (c) 2014 Wladimir J. van der Laan
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+Removal of triangles that cover no pixels: triangles with a repeated index
+(including the degenerate triangles that join strips), triangles whose
+vertices are collinear, and duplicates of a triangle with the same winding.
+'''
+import numpy
+
+from mesh_ops import facelists_to_triangles
+from parse_bg import PRIM_TRIANGLES
+
+# Triangles with sin(angle) between two edges below this are collinear
+COLLINEAR_EPSILON = 1e-6
+
+def classify_triangles(positions, tris):
+    '''
+    Boolean masks (repeated, collinear, duplicate) over an (n, 3) triangle
+    array. Each triangle is in at most one class; of a set of duplicates the
+    first is kept.
+    '''
+    a, b, c = tris[:, 0], tris[:, 1], tris[:, 2]
+    repeated = (a == b) | (b == c) | (a == c)
+
+    p, q, r = positions[a], positions[b], positions[c]
+    e1 = q - p
+    e2 = r - p
+    cross = numpy.linalg.norm(numpy.cross(e1, e2), axis=1)
+    scale = numpy.linalg.norm(e1, axis=1) * numpy.linalg.norm(e2, axis=1)
+    collinear = ~repeated & (cross <= COLLINEAR_EPSILON * scale)
+
+    # rotate every triangle so that its smallest index comes first, which
+    # keeps the winding; equal rows are then duplicates
+    shift = numpy.argmin(tris, axis=1)
+    cols = (shift[:, None] + numpy.arange(3)[None, :]) % 3
+    canonical = numpy.take_along_axis(tris, cols, axis=1)
+    valid = ~(repeated | collinear)
+    duplicate = numpy.zeros(len(tris), dtype=bool)
+    idx = numpy.nonzero(valid)[0]
+    unique, first = numpy.unique(canonical[idx], axis=0, return_index=True)
+    duplicate[idx] = True
+    duplicate[idx[first]] = False
+    return (repeated, collinear, duplicate)
+
+def cleanup_background(bgdata):
+    '''
+    Remove degenerate and duplicate triangles from every submesh of a parsed
+    background (parse_bg with as_numpy=True). Each submesh becomes one
+    triangle list. Returns (bgdata, report) with per submesh
+    (triangles, repeated, collinear, duplicate).
+    '''
+    bgdata_new = []
+    report = []
+    for numverts,vertsize,vertdata,facelists in bgdata:
+        tris = facelists_to_triangles(facelists, drop_degenerate=False)
+        positions = vertdata['position'][:, :3].astype(numpy.float64)
+        repeated, collinear, duplicate = classify_triangles(positions, tris)
+        keep = ~(repeated | collinear | duplicate)
+        indices = tris[keep].reshape(-1)
+        bgdata_new.append((numverts, vertsize, vertdata, [(PRIM_TRIANGLES, len(indices), indices)] if len(indices) else []))
+        report.append((len(tris), int(repeated.sum()), int(collinear.sum()), int(duplicate.sum())))
+    return (bgdata_new, report)
+
+def print_report(report):
+    for i, (total, repeated, collinear, duplicate) in enumerate(report):
+        print(f'  submesh {i:>3d}: {total:>8d} triangles, {repeated:>7d} repeated index, '
+              f'{collinear:>7d} collinear, {duplicate:>7d} duplicate')
+
+def main():
+    import argparse
+    from parse_bg import parse_bg
+    parser = argparse.ArgumentParser(description='Count degenerate and duplicate triangles')
+    parser.add_argument('filenames', metavar='FILENAME.HOD', nargs='+', help='Names of background meshes')
+    args = parser.parse_args()
+
+    for filename in args.filenames:
+        bgdata, report = cleanup_background(parse_bg(filename, as_numpy=True))
+        print(filename)
+        print_report(report)
+        total, repeated, collinear, duplicate = numpy.sum(report, axis=0) if report else (0, 0, 0, 0)
+        print(f'  total: {total} triangles, {repeated + collinear + duplicate} removed')
+
+if __name__ == '__main__':
+    main()
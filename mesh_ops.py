@@ -0,0 +1,246 @@
+# Copyright (c) 2014 Wladimir J. van der Laan
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+Vectorized mesh processing on parsed backgrounds (parse_bg with
+as_numpy=True).
+'''
+import numpy
+
+from parse_bg import PRIM_TRIANGLES, PRIM_TRIANGLE_STRIP
+
+# Options for primitive restart
+PRIMITIVE_RESTART_NONE = 0
+PRIMITIVE_RESTART_CORE = 1
+PRIMITIVE_RESTART_NV = 2
+
+PRIMITIVE_RESTART_INDEX = 65535
+# Primitive restart index per index size in bytes
+PRIMITIVE_RESTART_INDICES = {2: PRIMITIVE_RESTART_INDEX, 4: 0xffffffff}
+
+def strip_to_triangles(strip):
+    '''
+    Convert a triangle strip to an (n, 3) array of triangles, flipping every
+    odd triangle so that all of them keep the winding of the first, and
+    dropping degenerate triangles.
+    '''
+    return strips_to_triangles([strip])
+
+def strips_to_triangles(strips, drop_degenerate=True):
+    '''
+    Convert a number of triangle strips to one (n, 3) array of triangles, in
+    a single vectorized pass over the concatenated strips.
+    '''
+    strips = [numpy.asarray(strip) for strip in strips]
+    if not strips:
+        return numpy.zeros((0, 3), dtype=numpy.uint16)
+    joined = numpy.concatenate(strips)
+    if len(joined) < 3:
+        return numpy.zeros((0, 3), dtype=joined.dtype)
+    lengths = numpy.array([len(strip) for strip in strips])
+    starts = numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+    # position of each triangle's first vertex within its strip
+    local = numpy.arange(len(joined) - 2) - starts[:-2]
+    inside = local <= numpy.repeat(lengths, lengths)[:-2] - 3
+    a, b, c = joined[:-2], joined[1:-1], joined[2:]
+    odd = (local & 1).astype(bool)
+    tris = numpy.stack((numpy.where(odd, b, a), numpy.where(odd, a, b), c), axis=1)
+    keep = inside
+    if drop_degenerate:
+        keep &= (a != b) & (b != c) & (a != c)
+    return tris[keep]
+
+def facelists_to_triangles(facelists, drop_degenerate=True):
+    '''
+    All triangles of a submesh's face lists, as one (n, 3) array.
+    '''
+    strips = []
+    parts = []
+    for typ, count, facedata in facelists:
+        if typ == PRIM_TRIANGLE_STRIP:
+            strips.append(facedata)
+        elif typ == PRIM_TRIANGLES:
+            parts.append(numpy.asarray(facedata).reshape(-1, 3))
+        else:
+            raise ValueError(f'Unknown primitive type {typ}')
+    if strips:
+        parts.insert(0, strips_to_triangles(strips, drop_degenerate))
+    if not parts:
+        return numpy.zeros((0, 3), dtype=numpy.uint16)
+    return numpy.concatenate(parts)
+
+def vertex_colors(vertdata):
+    '''
+    Vertex colors as float RGB in [0, 1], decoded the way the viewer's shader
+    does: normalized signed bytes, swizzled from abgr.
+    '''
+    color = vertdata['color'].astype(numpy.float32) / 127.0
+    return numpy.clip(color[:, [3, 2, 1]], 0.0, 1.0)
+
+def index_dtype(numverts):
+    '''
+    Smallest index type for a vertex count. 16-bit indices leave 65535
+    free as primitive restart index.
+    '''
+    return numpy.uint16 if numverts < 65535 else numpy.uint32
+
+def merge_submeshes(bgdata):
+    '''
+    Merge all submeshes of a parsed background (parse_bg with as_numpy=True)
+    into one, welding identical vertices (same bytes, so the same position
+    and color) and converting all face lists to a single triangle list.
+    Returns a background with one submesh.
+    '''
+    dtypes = {vertdata.dtype for numverts,vertsize,vertdata,facelists in bgdata}
+    if len(dtypes) != 1:
+        raise ValueError('Cannot merge submeshes with different vertex formats')
+    dtype = dtypes.pop()
+    vertdata = numpy.concatenate([vertdata for numverts,vertsize,vertdata,facelists in bgdata])
+    tris = []
+    base = 0
+    for numverts,vertsize,submesh_verts,facelists in bgdata:
+        tris.append(facelists_to_triangles(facelists).astype(numpy.int64) + base)
+        base += numverts
+    tris = numpy.concatenate(tris)
+
+    # weld: unique over the raw vertex bytes, keeping first-occurrence order
+    raw = numpy.ascontiguousarray(vertdata).view(numpy.dtype((numpy.void, dtype.itemsize)))
+    unique, first, inverse = numpy.unique(raw, return_index=True, return_inverse=True)
+    order = numpy.argsort(first)
+    rank = numpy.empty(len(order), dtype=numpy.int64)
+    rank[order] = numpy.arange(len(order))
+    vertdata = vertdata[first[order]]
+    indices = rank[inverse.reshape(-1)][tris].reshape(-1).astype(index_dtype(len(vertdata)))
+    facelists = [(PRIM_TRIANGLES, len(indices), indices)] if len(indices) else []
+    return [(len(vertdata), dtype.itemsize, vertdata, facelists)]
+
+def triangulate(bgdata):
+    '''
+    Convert the face lists of every submesh to a single triangle list, so
+    that drawing needs neither primitive restart nor degenerate triangles.
+    '''
+    bgdata_new = []
+    for numverts,vertsize,vertdata,facelists in bgdata:
+        indices = facelists_to_triangles(facelists).reshape(-1)
+        bgdata_new.append((numverts, vertsize, vertdata, [(PRIM_TRIANGLES, len(indices), indices)] if len(indices) else []))
+    return bgdata_new
+
+def concatenate_primitives(bgdata, restart_mode):
+    '''
+    Join the triangle strips and the triangle lists of every submesh into
+    one of each, like build_buffers does, but as separate arrays. Kept for
+    comparison in benchmark.py.
+    '''
+    bgdata_new = []
+    for numverts,vertsize,vertdata,facelists in bgdata:
+        # concatenate triangles, as well as triangle strips, into different buffers
+        triangles = []
+        triangle_strip = []
+
+        for typ, count, facedata in facelists:
+            assert(len(facedata) == count)
+            if typ == PRIM_TRIANGLE_STRIP:
+                if triangle_strip:
+                    if restart_mode == PRIMITIVE_RESTART_NONE:
+                        # create two degenerate triangles in between
+                        triangle_strip.append(numpy.concatenate(
+                                (triangle_strip[-1][-1:], facedata[:1])))
+                    else:
+                        triangle_strip.append(numpy.array([PRIMITIVE_RESTART_INDICES[facedata.itemsize]], dtype=facedata.dtype))
+                triangle_strip.append(facedata)
+            elif typ == PRIM_TRIANGLES:
+                triangles.append(facedata)
+            else:
+                raise ValueError(f'Unknown primitive type {typ}')
+
+        facelists_new = []
+        if triangle_strip:
+            joined = numpy.concatenate(triangle_strip)
+            facelists_new.append((PRIM_TRIANGLE_STRIP, len(joined), joined))
+        if triangles:
+            joined = numpy.concatenate(triangles)
+            facelists_new.append((PRIM_TRIANGLES, len(joined), joined))
+
+        bgdata_new.append((numverts,vertsize,vertdata,facelists_new))
+
+    return bgdata_new
+
+def build_buffers(bgdata, restart_mode, rebase=False):
+    '''
+    Pack a background into one vertex buffer and one index buffer, and build
+    the nbgdata draw table with offsets into them. Per submesh the triangle
+    strips are joined into one strip (with primitive restart or degenerate
+    triangles, depending on restart_mode) and the triangle lists into one
+    list. The exact buffer sizes are computed from the face list headers
+    first, then the data is copied once into the preallocated buffers.
+
+    With rebase, indices are made relative to the start of the vertex buffer
+    instead of to their submesh, when all submeshes have the same vertex
+    format. The index width is chosen from the number of vertices indexed.
+    '''
+    rebase = rebase and len({vertdata.dtype for numverts,vertsize,vertdata,facelists in bgdata}) == 1
+    totalverts = sum(len(vertdata) for numverts,vertsize,vertdata,facelists in bgdata)
+    # pass 1: layout and draw table
+    vertdata_ptr = 0
+    facedata_ptr = 0
+    nbgdata = []
+    layout = []
+    for numverts,vertsize,vertdata,facelists in bgdata:
+        vertdata_offset = vertdata_ptr
+        vertdata_ptr += vertdata.nbytes
+        # byte offsets of the attributes within a vertex, from the vertex format
+        attrib_offsets = {name: field[1] for name, field in vertdata.dtype.fields.items()}
+        byprim = {PRIM_TRIANGLE_STRIP: [], PRIM_TRIANGLES: []}
+        for typ, count, facedata in facelists:
+            assert(len(facedata) == count)
+            if typ not in byprim:
+                raise ValueError(f'Unknown primitive type {typ}')
+            if count:
+                byprim[typ].append(facedata)
+        nfacelists = []
+        for typ, parts in byprim.items():
+            if not parts:
+                continue
+            index_size = numpy.dtype(index_dtype(totalverts if rebase else len(vertdata))).itemsize
+            count = sum(map(len, parts))
+            if typ == PRIM_TRIANGLE_STRIP:
+                count += (len(parts) - 1) * (2 if restart_mode == PRIMITIVE_RESTART_NONE else 1)
+            # align 32-bit indices
+            facedata_ptr += -facedata_ptr % index_size
+            nfacelists.append((typ, count, facedata_ptr, index_size))
+            layout.append((typ, facedata_ptr, count, index_size, parts,
+                           vertdata_offset // vertdata.itemsize if rebase else 0))
+            facedata_ptr += count * index_size
+        nbgdata.append((numverts, vertsize, vertdata_offset, attrib_offsets, nfacelists))
+
+    # pass 2: fill
+    allvertdata = numpy.empty(vertdata_ptr, dtype=numpy.uint8)
+    for (numverts,vertsize,vertdata,facelists), mesh in zip(bgdata, nbgdata):
+        allvertdata[mesh[2]:mesh[2]+vertdata.nbytes] = numpy.frombuffer(numpy.ascontiguousarray(vertdata), dtype=numpy.uint8)
+    allfacedata = numpy.zeros(facedata_ptr, dtype=numpy.uint8)
+    for typ, offset, count, index_size, parts, base in layout:
+        out = allfacedata[offset:offset+count*index_size].view(numpy.uint16 if index_size == 2 else numpy.uint32)
+        restarts = None
+        if typ == PRIM_TRIANGLE_STRIP and len(parts) > 1:
+            pieces = [parts[0]]
+            if restart_mode == PRIMITIVE_RESTART_NONE:
+                for prev, facedata in zip(parts, parts[1:]):
+                    # create two degenerate triangles in between
+                    pieces.append(numpy.array([prev[-1], facedata[0]], dtype=out.dtype))
+                    pieces.append(facedata)
+            else:
+                # placeholder, the restart index is stored after rebasing
+                marker = numpy.zeros(1, dtype=out.dtype)
+                for facedata in parts[1:]:
+                    pieces.append(marker)
+                    pieces.append(facedata)
+                restarts = numpy.cumsum([len(facedata) + 1 for facedata in parts[:-1]]) - 1
+        else:
+            pieces = parts
+        # one copy into the preallocated buffer instead of one per face list
+        numpy.concatenate(pieces, out=out, casting='unsafe')
+        if base:
+            out += base
+        if restarts is not None:
+            out[restarts] = PRIMITIVE_RESTART_INDICES[index_size]
+    return (allvertdata, allfacedata, nbgdata)
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+# Copyright (c) 2014 Wladimir J. van der Laan
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+Content-addressed store of background meshes. Every BMSH vertex block and
+face list is stored once under its SHA-256, and a background is a manifest
+of block hashes. Backgrounds that share submeshes (such as mod copies of the
+stock backgrounds) share the blocks on disk, in memory and, through
+build_shared_buffers, in GPU buffers.
+'''
+import hashlib
+import json
+import mmap
+import numpy
+import os
+
+from parse_bg import parse_bg, vertex_dtype, vertex_mask
+
+DEFAULT_STORE = 'mesh_store'
+
+def block_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+class MeshStore(object):
+    def __init__(self, root=DEFAULT_STORE):
+        self.root = root
+        # blocks that are in memory, shared between all loaded backgrounds
+        self.blocks = {}
+
+    def _block_path(self, digest):
+        return os.path.join(self.root, 'blocks', digest[:2], digest)
+
+    def _manifest_path(self, name):
+        return os.path.join(self.root, 'manifests', name + '.json')
+
+    def put_block(self, data):
+        '''
+        Store a block if it is not present yet. Returns its hash.
+        '''
+        digest = block_hash(data)
+        path = self._block_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmpname = path + '.tmp'
+            with open(tmpname, 'wb') as f:
+                f.write(data)
+            os.replace(tmpname, path)
+        return digest
+
+    def get_block(self, digest):
+        '''
+        Memory-mapped contents of a block. Each block is mapped only once, no
+        matter how many backgrounds refer to it.
+        '''
+        data = self.blocks.get(digest)
+        if data is None:
+            with open(self._block_path(digest), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    data = b''
+                else:
+                    data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            self.blocks[digest] = data
+        return data
+
+    def add_background(self, filename, name=None):
+        '''
+        Store the submeshes of a background and write its manifest. Returns
+        the manifest.
+        '''
+        if name is None:
+            name = os.path.splitext(os.path.basename(filename.replace('\\', '/')))[0]
+        manifest = []
+        for numverts,vertsize,vertdata,facelists in parse_bg(filename, use_mmap=True, as_numpy=True):
+            manifest.append({
+                'numverts': numverts,
+                'vertsize': vertsize,
+                'vertmask': vertex_mask(vertdata.dtype),
+                'vertdata': self.put_block(vertdata),
+                'facelists': [(typ, count, self.put_block(facedata)) for typ, count, facedata in facelists],
+            })
+        path = self._manifest_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        return manifest
+
+    def manifest(self, name):
+        with open(self._manifest_path(name), 'r') as f:
+            return json.load(f)
+
+    def names(self):
+        try:
+            return sorted(os.path.splitext(n)[0] for n in os.listdir(os.path.join(self.root, 'manifests')))
+        except OSError:
+            return []
+
+    def load_background(self, name):
+        '''
+        Background in the format returned by parse_bg(as_numpy=True). The
+        arrays are views on the shared, memory-mapped blocks.
+        '''
+        bgdata = []
+        for mesh in self.manifest(name):
+            vertdata = numpy.frombuffer(self.get_block(mesh['vertdata']), dtype=vertex_dtype(mesh['vertmask']))
+            facelists = [(typ, count, numpy.frombuffer(self.get_block(digest), dtype='<u2'))
+                    for typ, count, digest in mesh['facelists']]
+            bgdata.append((mesh['numverts'], mesh['vertsize'], vertdata, facelists))
+        return bgdata
+
+    def stats(self):
+        '''
+        Bytes referenced by all manifests and bytes actually stored.
+        '''
+        referenced = 0
+        unique = {}
+        for name in self.names():
+            for mesh in self.manifest(name):
+                digests = [mesh['vertdata']] + [digest for typ, count, digest in mesh['facelists']]
+                for digest in digests:
+                    size = os.path.getsize(self._block_path(digest))
+                    referenced += size
+                    unique[digest] = size
+        return {'backgrounds': len(self.names()), 'blocks': len(unique),
+                'referenced_bytes': referenced, 'stored_bytes': sum(unique.values())}
+
+def build_shared_buffers(store, names):
+    '''
+    Build one vertex buffer and one index buffer holding every distinct block
+    of the given backgrounds once, plus a draw table per background (in the
+    viewer's nbgdata format) pointing into them. Returns
+    (vertdata, facedata, {name: nbgdata}).
+    '''
+    vert_offsets = {}
+    face_offsets = {}
+    allvertdata = []
+    allfacedata = []
+    vertdata_ptr = facedata_ptr = 0
+    tables = {}
+    for name in names:
+        nbgdata = []
+        for mesh in store.manifest(name):
+            digest = mesh['vertdata']
+            if digest not in vert_offsets:
+                data = store.get_block(digest)
+                vert_offsets[digest] = vertdata_ptr
+                allvertdata.append(data)
+                vertdata_ptr += len(data)
+            nfacelists = []
+            for typ, count, digest in mesh['facelists']:
+                if digest not in face_offsets:
+                    data = store.get_block(digest)
+                    face_offsets[digest] = facedata_ptr
+                    allfacedata.append(data)
+                    facedata_ptr += len(data)
+                nfacelists.append((typ, count, face_offsets[digest], 2))
+            attrib_offsets = {attr: field[1] for attr, field in vertex_dtype(mesh['vertmask']).fields.items()}
+            nbgdata.append((mesh['numverts'], mesh['vertsize'], vert_offsets[mesh['vertdata']],
+                    attrib_offsets, nfacelists))
+        tables[name] = nbgdata
+    return (b''.join(allvertdata), b''.join(allfacedata), tables)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Homeworld 2 content-addressed mesh store')
+    parser.add_argument('--store', default=DEFAULT_STORE, help='Store directory')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_parser = subparsers.add_parser('add', help='Add backgrounds to the store')
+    add_parser.add_argument('filenames', metavar='FILENAME.HOD', nargs='+', help='Names of background meshes')
+    subparsers.add_parser('stats', help='Show deduplication statistics')
+    args = parser.parse_args()
+
+    store = MeshStore(args.store)
+    if args.command == 'add':
+        for filename in args.filenames:
+            store.add_background(filename)
+    stats = store.stats()
+    print(f"{stats['backgrounds']} backgrounds, {stats['blocks']} blocks, "
+          f"{stats['referenced_bytes']/1e6:.2f} MB referenced, {stats['stored_bytes']/1e6:.2f} MB stored")
+
+if __name__ == '__main__':
+    main()
@@ -3,14 +3,72 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 '''Parse homeworld 2 background'''
 from __future__ import division, print_function 
+from concurrent.futures import ThreadPoolExecutor
+import mmap
+import numpy
+import os
 import struct
 
-NESTED={b'BGMS'}
+from big_archive import open_archive, read_big_path, split_big_path
+
+# Forms that contain other chunks: the HVMD form of ship meshes, and the
+# background, multi-mesh and goblin mesh forms in it
+NESTED={b'HVMD', b'BGMS', b'MULT', b'GOBG'}
 
 PRIM_TRIANGLES = 514
 PRIM_TRIANGLE_STRIP = 518
 
-def parse_BMSH(data):
+# Vertex components in the order in which they appear in a vertex, with the
+# vertex mask bit that enables them. Backgrounds use position|color (5),
+# ship meshes position|normal|uv (11) or position|normal|uv|tangent (27).
+VERTEX_COMPONENTS = [
+    (0x01, 'position', ('<f4', (4,))),
+    (0x02, 'normal', ('<f4', (4,))),
+    (0x04, 'color', ('i1', (4,))),
+    (0x08, 'uv', ('<f4', (2,))),
+    (0x10, 'tangent', ('<f4', (4,))),
+    (0x20, 'binormal', ('<f4', (4,))),
+]
+VERTEX_MASK_ALL = 0x3f
+
+def vertex_dtype(vertmask):
+    '''
+    Structured dtype for the vertex format described by a BMSH vertex mask.
+    '''
+    if vertmask & ~VERTEX_MASK_ALL:
+        raise ValueError(f'Unknown vertex mask bits {vertmask:#x}')
+    return numpy.dtype([(name, fmt) for bit, name, fmt in VERTEX_COMPONENTS if vertmask & bit])
+
+def vertex_mask(vtype):
+    '''
+    Inverse of vertex_dtype: the vertex mask for a structured vertex dtype.
+    '''
+    return sum(bit for bit, name, fmt in VERTEX_COMPONENTS if name in vtype.names)
+
+def vertex_attributes(vertdata):
+    '''
+    Split a structured vertex array into a dict of per-attribute views.
+    '''
+    return {name: vertdata[name] for name in vertdata.dtype.names}
+
+def form_header_size(blkid, data, ofs):
+    '''
+    Size of the header that precedes the nested chunks of a form. MULT and
+    GOBG forms start with a version and mesh and joint names, MULT forms
+    also with a BMSH count.
+    '''
+    if blkid not in (b'MULT', b'GOBG'):
+        return 0
+    start = ofs
+    ofs += 4 # version
+    for x in range(0, 2): # mesh name, joint name
+        namelen, = struct.unpack_from('<I', data, ofs)
+        ofs += 4 + namelen
+    if blkid == b'MULT':
+        ofs += 4 # number of BMSH forms
+    return ofs - start
+
+def parse_BMSH(data, as_numpy=False):
     '''
     "NRML"
     <num bytes for this form>, {ulong}
@@ -39,67 +97,210 @@ def parse_BMSH(data):
     <face list, in triplets, LE>, ushort (Important!!! This starts from zero! wOBJ starts from 1!)
       (Strips are a bit... different that lists, Stay Sharp)
     ---- end ---- 
+
+    The fields from the material number on repeat for each of the meshes
+    in the form. Returns a (numverts, vertsize, vertdata, facelists) tuple
+    per mesh.
+
+    The vertex size is derived from the vertex mask (see vertex_dtype). If
+    as_numpy is set, the vertex data is returned as a structured array of
+    that dtype and each face list as an uint16 array.
+    Both are views on data, not copies.
     '''
     # From: http://forums.relicnews.com/showthread.php?99226-HOD-File-Format-%28Regardless-of-type%29
     version, = struct.unpack('>I', data[0:4])
     #print('---------------------------------')
     #print('Version', version)
-    lod,num,mat,vertsize,numverts = struct.unpack('<IIIII', data[4:24])
+    lod,num = struct.unpack('<II', data[4:12])
     #print('LOD', lod)
     #print('num', num)
-    #print('mat', mat)
-    #print('vertmask', vertmask)
-    #print('numverts', numverts)
-    ofs = 24
-    vertsize *= 4
-    vertdata = data[ofs:ofs+vertsize*numverts]
-    ofs += vertsize*numverts
-    numfacelists, = struct.unpack('<H', data[ofs:ofs+2])
-    #print('numfacelists', numfacelists)
-    ofs += 2
-    facelists = []
-    for x in range(0, numfacelists):
-        listtype,listcount = struct.unpack('<II', data[ofs:ofs+8])
-        ofs += 8
-        if listtype == PRIM_TRIANGLES:
-            assert((listcount % 3)==0)
-        elif listtype == PRIM_TRIANGLE_STRIP:
-            assert(listcount >= 3) # at least one full triangle
-        fdata = data[ofs:ofs+2*listcount]
-        ofs += 2*listcount
-        facelists.append((listtype, listcount, fdata))
+    ofs = 12
+    meshes = []
+    for m in range(0, num):
+        mat,vertmask,numverts = struct.unpack('<III', data[ofs:ofs+12])
+        #print('mat', mat)
+        #print('vertmask', vertmask)
+        #print('numverts', numverts)
+        ofs += 12
+        vtype = vertex_dtype(vertmask)
+        vertsize = vtype.itemsize
+        vertdata = data[ofs:ofs+vertsize*numverts]
+        ofs += vertsize*numverts
+        numfacelists, = struct.unpack('<H', data[ofs:ofs+2])
+        #print('numfacelists', numfacelists)
+        ofs += 2
+        facelists = []
+        for x in range(0, numfacelists):
+            listtype,listcount = struct.unpack('<II', data[ofs:ofs+8])
+            ofs += 8
+            if listtype == PRIM_TRIANGLES:
+                assert((listcount % 3)==0)
+            elif listtype == PRIM_TRIANGLE_STRIP:
+                assert(listcount >= 3) # at least one full triangle
+            fdata = data[ofs:ofs+2*listcount]
+            if as_numpy:
+                fdata = numpy.frombuffer(fdata, dtype='<u2')
+            ofs += 2*listcount
+            facelists.append((listtype, listcount, fdata))
+        if as_numpy:
+            vertdata = numpy.frombuffer(vertdata, dtype=vtype)
+        meshes.append((numverts, vertsize, vertdata, facelists))
     #print('---------------------------------')
-    return (numverts, vertsize, vertdata, facelists)
+    return meshes
 
 class BackgroundParser(object):
-    def __init__(self):
+    def __init__(self, as_numpy=False):
         self.bmshes = []
+        self.as_numpy = as_numpy
 
-    def parse_block(self, data, nesting=0):
-        ofs = 0
-        while ofs < len(data):
-            outer_blkid = data[ofs:ofs+4]
+    def parse_block(self, data, ofs=0, end=None, nesting=0):
+        '''
+        Parse the chunks in data[ofs:end]. data is expected to be a memoryview,
+        so that the slices handed to nested blocks and parse_BMSH are views
+        into the original buffer instead of copies.
+        '''
+        if end is None:
+            end = len(data)
+        while ofs < end:
+            outer_blkid = bytes(data[ofs:ofs+4])
             ofs += 4
 
-            size, = struct.unpack('>I', data[ofs:ofs+4])
+            size, = struct.unpack_from('>I', data, ofs)
             ofs += 4
 
-            blkid = data[ofs:ofs+4] # form has nested blkid
+            blkid = bytes(data[ofs:ofs+4]) # form has nested blkid
             ofs += 4
             size -= 4
 
-            inner = data[ofs:ofs+size]
             if blkid in NESTED:
-                self.parse_block(inner, nesting+1)
+                self.parse_block(data, ofs+form_header_size(blkid, data, ofs), ofs+size, nesting+1)
             if blkid == b'BMSH':
-                bmsh = parse_BMSH(inner)
-                self.bmshes.append(bmsh)
+                self.bmshes.extend(parse_BMSH(data[ofs:ofs+size], self.as_numpy))
             ofs += size
 
-def parse_bg(filename):
-    parser = BackgroundParser()
-    f = open(filename, 'rb')
-    parser.parse_block(f.read())
-    f.close()
+def iter_chunks(data, ofs=0, end=None, path=()):
+    '''
+    Walk the chunk headers in data[ofs:end] without decoding any payloads,
+    descending into nested forms. Yields (path, blkid, offset, size) per
+    chunk, where path is the tuple of enclosing form ids and offset/size
+    describe the payload following the chunk id.
+    '''
+    if end is None:
+        end = len(data)
+    while ofs < end:
+        size, = struct.unpack_from('>I', data, ofs+4)
+        blkid = bytes(data[ofs+8:ofs+12]) # form has nested blkid
+        ofs += 12
+        size -= 4
+        yield (path, blkid, ofs, size)
+        if blkid in NESTED:
+            yield from iter_chunks(data, ofs+form_header_size(blkid, data, ofs), ofs+size, path + (blkid,))
+        ofs += size
+
+def parse_bmshes_threaded(data, threads, as_numpy=False):
+    '''
+    Decode the BMSH chunks in data concurrently on a pool of threads. A
+    header-only pass finds the chunks first; results are in file order.
+    '''
+    spans = [(ofs, size) for path, blkid, ofs, size in iter_chunks(data) if blkid == b'BMSH']
+    with ThreadPoolExecutor(threads) as pool:
+        results = pool.map(lambda span: parse_BMSH(data[span[0]:span[0]+span[1]], as_numpy), spans)
+        return [mesh for meshes in results for mesh in meshes]
+
+def parse_bg(filename, use_mmap=False, as_numpy=False, threads=0):
+    '''
+    Parse a background HOD file. Vertex and face data are returned as
+    memoryviews into the file contents, or NumPy views if as_numpy is set.
+    If use_mmap is set, the file is memory-mapped instead of read, and the
+    returned views keep the mapping alive. If threads is non-zero the BMSH
+    chunks are decoded on that many threads. filename can also refer to a
+    file inside a .big archive, as in "Homeworld2.big:background/m05.hod".
+    '''
+    data = read_big_path(filename)
+    if data is None:
+        with open(filename, 'rb') as f:
+            if use_mmap and os.fstat(f.fileno()).st_size > 0:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
+    if threads:
+        return parse_bmshes_threaded(memoryview(data), threads, as_numpy)
+    parser = BackgroundParser(as_numpy)
+    parser.parse_block(memoryview(data))
     return parser.bmshes
 
+def _read_exactly(f, size):
+    '''
+    Read exactly size bytes from f, which may be a non-seekable stream that
+    returns short reads.
+    '''
+    buf = bytearray(size)
+    view = memoryview(buf)
+    ofs = 0
+    while ofs < size:
+        n = f.readinto(view[ofs:])
+        if not n:
+            raise ValueError('Truncated HOD file')
+        ofs += n
+    return buf
+
+def _skip(f, size):
+    if f.seekable():
+        f.seek(size, 1)
+    else:
+        while size > 0:
+            n = len(f.read(min(size, 65536)))
+            if not n:
+                raise ValueError('Truncated HOD file')
+            size -= n
+
+def _read_form_header(f, blkid):
+    '''
+    Consume the header of a nested form from a stream (see form_header_size)
+    and return its size.
+    '''
+    if blkid not in (b'MULT', b'GOBG'):
+        return 0
+    header = _read_exactly(f, 8) # version, mesh name length
+    namelen, = struct.unpack_from('<I', header, 4)
+    header += _read_exactly(f, namelen + 4) # mesh name, joint name length
+    jointlen, = struct.unpack_from('<I', header, len(header)-4)
+    header += _read_exactly(f, jointlen + (4 if blkid == b'MULT' else 0))
+    return len(header)
+
+def parse_bg_iter(f, as_numpy=False):
+    '''
+    Parse a background HOD file incrementally, yielding the meshes of each
+    BMSH as soon as it has been read. f can be a filename (including .big archive paths, see
+    parse_bg) or a binary file-like object, which does not need to be
+    seekable. Only one BMSH is held in memory at a time.
+    '''
+    if isinstance(f, (str, bytes, os.PathLike)):
+        archive, member = split_big_path(os.fsdecode(f))
+        with (open_archive(archive).open(member) if archive else open(f, 'rb')) as fo:
+            yield from parse_bg_iter(fo, as_numpy)
+        return
+    ends = [] # end offsets of the enclosing nested forms
+    pos = 0
+    while True:
+        while ends and pos >= ends[-1]:
+            ends.pop()
+        header = f.read(12)
+        if not header and not ends:
+            return
+        if len(header) < 12:
+            header += _read_exactly(f, 12 - len(header))
+        size, = struct.unpack_from('>I', header, 4)
+        blkid = header[8:12] # form has nested blkid
+        pos += 12
+        size -= 4
+
+        if blkid in NESTED:
+            ends.append(pos + size)
+            pos += _read_form_header(f, blkid)
+            continue
+        if blkid == b'BMSH':
+            yield from parse_BMSH(memoryview(_read_exactly(f, size)), as_numpy)
+        else:
+            _skip(f, size)
+        pos += size
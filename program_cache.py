@@ -0,0 +1,132 @@
+# Copyright (c) 2014 Wladimir J. van der Laan
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+On-disk cache of linked GL programs (ARB_get_program_binary / GL 4.1), so
+that shaders are not compiled and linked again on every launch.
+
+Program binaries are only valid for the driver that produced them, so the
+cache key includes the GL vendor, renderer and version strings next to the
+shader sources. The driver can still reject a binary (for example after an
+update that kept the version string); then the program is built from source.
+'''
+from OpenGL.GL import *
+from OpenGL.GL import shaders
+from OpenGL.GL.ARB.get_program_binary import *
+import hashlib
+import numpy
+import os
+import struct
+
+from bg_cache import cache_dir
+
+PROGRAM_MAGIC = b'HWPB'
+# magic, binary format
+HEADER_FORMAT = '<4sI'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+def binaries_supported():
+    try:
+        return bool(glGetProgramBinary) and glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS) > 0
+    except GLError:
+        return False
+
+def program_key(sources):
+    '''
+    Cache key for a program built from the given shader sources with the
+    current GL context.
+    '''
+    h = hashlib.sha256()
+    for item in list(sources) + [glGetString(GL_VENDOR), glGetString(GL_RENDERER), glGetString(GL_VERSION)]:
+        h.update(item or b'')
+        h.update(b'\0')
+    return h.hexdigest()
+
+def program_path(key):
+    return os.path.join(cache_dir(), 'programs', key + '.bin')
+
+def link_program(compiled, retrievable=False):
+    '''
+    Link compiled shaders into a program. Raises RuntimeError if linking
+    fails.
+    '''
+    program = glCreateProgram()
+    for shader in compiled:
+        glAttachShader(program, shader)
+    if retrievable:
+        glProgramParameteri(program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+    glLinkProgram(program)
+    if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+        log = glGetProgramInfoLog(program)
+        glDeleteProgram(program)
+        raise RuntimeError(f'Link failure: {log}')
+    for shader in compiled:
+        glDetachShader(program, shader)
+        glDeleteShader(shader)
+    return program
+
+def load_program(key):
+    '''
+    Create a program from a cached binary. Returns None if there is no
+    cached binary or the driver rejects it.
+    '''
+    try:
+        with open(program_path(key), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if len(data) <= HEADER_SIZE:
+        return None
+    magic, binary_format = struct.unpack_from(HEADER_FORMAT, data, 0)
+    if magic != PROGRAM_MAGIC:
+        return None
+    binary = numpy.frombuffer(data, dtype=numpy.uint8, offset=HEADER_SIZE)
+    program = glCreateProgram()
+    try:
+        glProgramBinary(program, binary_format, binary, len(binary))
+        ok = glGetProgramiv(program, GL_LINK_STATUS) == GL_TRUE
+    except GLError:
+        ok = False
+    if not ok:
+        glDeleteProgram(program)
+        return None
+    return program
+
+def save_program(program, key):
+    '''
+    Store the binary of a linked program in the cache.
+    '''
+    size = glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH)
+    if size <= 0:
+        return
+    binary = numpy.empty(size, dtype=numpy.uint8)
+    length = numpy.zeros(1, dtype=numpy.int32)
+    binary_format = numpy.zeros(1, dtype=numpy.uint32)
+    glGetProgramBinary(program, size, length, binary_format, binary)
+    path = program_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmpname = path + '.tmp'
+    with open(tmpname, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, PROGRAM_MAGIC, int(binary_format[0])))
+        f.write(binary[:int(length[0])].tobytes())
+    os.replace(tmpname, path)
+
+def cached_program(sources, use_cache=True):
+    '''
+    Program for a list of (source, shader type) pairs, loaded from the
+    binary cache when possible. Returns (program, cache hit).
+    '''
+    use_cache = use_cache and binaries_supported()
+    if use_cache:
+        key = program_key([source for source, shader_type in sources])
+        program = load_program(key)
+        if program is not None:
+            return (program, True)
+    program = link_program([shaders.compileShader(source, shader_type) for source, shader_type in sources],
+            retrievable=use_cache)
+    if use_cache:
+        try:
+            save_program(program, key)
+        except (OSError, GLError) as e:
+            print(f'Warning: could not write program cache: {e}')
+    return (program, False)
@@ -0,0 +1,162 @@
+# Copyright (c) 2014 Wladimir J. van der Laan
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+Software rendering of backgrounds to cubemaps and panoramas, for
+thumbnails and baking without an OpenGL context.
+'''
+import numpy
+import struct
+import zlib
+
+from mesh_ops import facelists_to_triangles, vertex_colors
+
+# Cube faces in OpenGL order (+x, -x, +y, -y, +z, -z): major axis, sign, and
+# the (axis, sign) pairs of the s and t texture directions.
+CUBE_FACES = [
+    ('px', 0, 1.0, (2, -1.0), (1, -1.0)),
+    ('nx', 0, -1.0, (2, 1.0), (1, -1.0)),
+    ('py', 1, 1.0, (0, 1.0), (2, 1.0)),
+    ('ny', 1, -1.0, (0, 1.0), (2, -1.0)),
+    ('pz', 2, 1.0, (0, 1.0), (1, -1.0)),
+    ('nz', 2, -1.0, (0, -1.0), (1, -1.0)),
+]
+
+# Triangles with a screen-space bounding box of at most this many pixels on
+# a side are rasterized in vectorized batches, larger ones one by one
+SMALL_TRIANGLE = 8
+BATCH = 16384
+
+def _raster_small(image, x0, y0, px, py, cols):
+    '''
+    Rasterize a batch of triangles with small bounding boxes. px, py: (n, 3)
+    pixel coordinates, cols: (n, 3, 3) vertex colors, x0, y0: (n,) bounding
+    box origins.
+    '''
+    size = image.shape[0]
+    d = numpy.arange(SMALL_TRIANGLE)
+    x = x0[:, None] + numpy.tile(d, SMALL_TRIANGLE)[None, :]
+    y = y0[:, None] + numpy.repeat(d, SMALL_TRIANGLE)[None, :]
+    _fill(image, x, y, px, py, cols, (x < size) & (y < size))
+
+def _fill(image, x, y, px, py, cols, valid):
+    '''
+    Write the pixels (x, y) that are inside their triangle, with the color
+    interpolated from the vertex colors.
+    '''
+    ax, ay = px[:, 0:1], py[:, 0:1]
+    bx, by = px[:, 1:2], py[:, 1:2]
+    cx, cy = px[:, 2:3], py[:, 2:3]
+    area = (bx - ax) * (cy - ay) - (cx - ax) * (by - ay)
+    area = numpy.where(area == 0.0, 1e-12, area)
+    w1 = ((x - ax) * (cy - ay) - (cx - ax) * (y - ay)) / area
+    w2 = ((bx - ax) * (y - ay) - (x - ax) * (by - ay)) / area
+    w0 = 1.0 - w1 - w2
+    eps = -1e-6
+    inside = valid & (w0 >= eps) & (w1 >= eps) & (w2 >= eps)
+    tri, pix = numpy.nonzero(inside)
+    color = (w0[tri, pix, None] * cols[tri, 0] + w1[tri, pix, None] * cols[tri, 1] +
+             w2[tri, pix, None] * cols[tri, 2])
+    image[y[tri, pix], x[tri, pix]] = color
+
+def render_face(positions, colors, tris, face, size):
+    '''
+    Rasterize triangles (indices into positions/colors) onto one cube face.
+    Returns a (size, size, 3) float image.
+    '''
+    name, axis, sign, (s_axis, s_sign), (t_axis, t_sign) = face
+    image = numpy.zeros((size, size, 3), dtype=numpy.float32)
+    ma = positions[:, axis] * sign
+    front = ma > 1e-6
+    safe_ma = numpy.where(front, ma, 1.0)
+    # pixel centers are at integer coordinates
+    u = ((positions[:, s_axis] * s_sign / safe_ma + 1.0) * 0.5) * size - 0.5
+    v = ((positions[:, t_axis] * t_sign / safe_ma + 1.0) * 0.5) * size - 0.5
+
+    # only triangles entirely in front of the face plane can cover the face
+    tris = tris[front[tris].all(axis=1)]
+    px = u[tris]
+    py = v[tris]
+    x0 = numpy.maximum(numpy.ceil(px.min(axis=1)), 0).astype(numpy.int64)
+    y0 = numpy.maximum(numpy.ceil(py.min(axis=1)), 0).astype(numpy.int64)
+    x1 = numpy.minimum(numpy.floor(px.max(axis=1)), size - 1).astype(numpy.int64)
+    y1 = numpy.minimum(numpy.floor(py.max(axis=1)), size - 1).astype(numpy.int64)
+    visible = (x1 >= x0) & (y1 >= y0)
+    small = visible & (x1 - x0 < SMALL_TRIANGLE) & (y1 - y0 < SMALL_TRIANGLE)
+
+    idx = numpy.nonzero(small)[0]
+    for start in range(0, len(idx), BATCH):
+        sel = idx[start:start+BATCH]
+        _raster_small(image, x0[sel], y0[sel], px[sel], py[sel], colors[tris[sel]])
+    for i in numpy.nonzero(visible & ~small)[0]:
+        xs = numpy.arange(x0[i], x1[i] + 1)
+        ys = numpy.arange(y0[i], y1[i] + 1)
+        x = numpy.tile(xs, len(ys))[None, :]
+        y = numpy.repeat(ys, len(xs))[None, :]
+        _fill(image, x, y, px[i:i+1], py[i:i+1], colors[tris[i:i+1]], numpy.ones(x.shape, dtype=bool))
+    return image
+
+def render_cubemap(bgdata, size=256):
+    '''
+    Render a parsed background (parse_bg with as_numpy=True) to the six faces
+    of a cubemap. Returns a dict from face name to (size, size, 3) image.
+    '''
+    positions = []
+    colors = []
+    tris = []
+    base = 0
+    for numverts,vertsize,vertdata,facelists in bgdata:
+        positions.append(vertdata['position'][:, :3].astype(numpy.float64))
+        colors.append(vertex_colors(vertdata))
+        tris.append(facelists_to_triangles(facelists).astype(numpy.int64) + base)
+        base += numverts
+    positions = numpy.concatenate(positions)
+    colors = numpy.concatenate(colors)
+    tris = numpy.concatenate(tris)
+    return {face[0]: render_face(positions, colors, tris, face, size) for face in CUBE_FACES}
+
+def sample_cubemap(faces, directions):
+    '''
+    Nearest-neighbour lookup of (n, 3) directions in a cubemap.
+    '''
+    size = faces['px'].shape[0]
+    absd = numpy.abs(directions)
+    major = absd.argmax(axis=1)
+    result = numpy.zeros((len(directions), 3), dtype=numpy.float32)
+    for name, axis, sign, (s_axis, s_sign), (t_axis, t_sign) in CUBE_FACES:
+        sel = (major == axis) & (numpy.sign(directions[:, axis]) == sign)
+        d = directions[sel]
+        ma = numpy.abs(d[:, axis])
+        u = ((d[:, s_axis] * s_sign / ma + 1.0) * 0.5 * size).astype(numpy.int64).clip(0, size - 1)
+        v = ((d[:, t_axis] * t_sign / ma + 1.0) * 0.5 * size).astype(numpy.int64).clip(0, size - 1)
+        result[sel] = faces[name][v, u]
+    return result
+
+def equirectangular(faces, width=256):
+    '''
+    Equirectangular panorama (width x width/2) of a cubemap, used as
+    thumbnail.
+    '''
+    height = width // 2
+    lon = (numpy.arange(width) + 0.5) / width * 2.0 * numpy.pi - numpy.pi
+    lat = numpy.pi / 2.0 - (numpy.arange(height) + 0.5) / height * numpy.pi
+    lon, lat = numpy.meshgrid(lon, lat)
+    directions = numpy.stack((numpy.cos(lat) * numpy.sin(lon), numpy.sin(lat),
+            numpy.cos(lat) * numpy.cos(lon)), axis=-1).reshape(-1, 3)
+    return sample_cubemap(faces, directions).reshape(height, width, 3)
+
+def write_png(filename, image):
+    '''
+    Write a float RGB image in [0, 1] as 8-bit PNG.
+    '''
+    height, width = image.shape[:2]
+    pixels = (numpy.clip(image, 0.0, 1.0) * 255.0 + 0.5).astype(numpy.uint8)
+    raw = numpy.zeros((height, 1 + width * 3), dtype=numpy.uint8) # filter type 0 per row
+    raw[:, 1:] = pixels.reshape(height, width * 3)
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+# Copyright (c) 2014 Wladimir J. van der Laan
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+Post-transform vertex cache optimization of backgrounds. Triangles are
+reordered for cache locality, then vertices are reordered in first-use
+order for fetch locality.
+
+The triangle order uses the linear-time Tipsify algorithm (Sander, Nehab
+and Barczak 2007), a greedy cache-aware ordering like Forsyth's that only
+rescores the vertices of the last emitted fan, which keeps it usable in
+pure Python on backgrounds with hundreds of thousands of triangles.
+'''
+import numpy
+
+from mesh_ops import facelists_to_triangles, index_dtype
+from parse_bg import PRIM_TRIANGLES, PRIM_TRIANGLE_STRIP
+
+# Cache size the ordering is optimized for, and the FIFO size used for
+# measuring. Most GPUs have an effective post-transform cache of 16-32
+# entries.
+DEFAULT_CACHE_SIZE = 16
+
+def cache_misses(indices, cache_size=DEFAULT_CACHE_SIZE):
+    '''
+    Number of misses of a FIFO vertex cache on an index stream.
+    '''
+    inserted = {}
+    misses = 0
+    for v in indices.tolist():
+        t = inserted.get(v)
+        if t is None or misses - t >= cache_size:
+            inserted[v] = misses
+            misses += 1
+    return misses
+
+def cache_stats(facelists, cache_size=DEFAULT_CACHE_SIZE):
+    '''
+    (ACMR, ATVR) of a submesh's face lists as drawn: average cache misses
+    per triangle and per referenced vertex.
+    '''
+    misses = 0
+    referenced = []
+    for typ, count, facedata in facelists:
+        misses += cache_misses(numpy.asarray(facedata), cache_size)
+        referenced.append(numpy.asarray(facedata))
+    numtris = len(facelists_to_triangles(facelists))
+    numverts = len(numpy.unique(numpy.concatenate(referenced))) if referenced else 0
+    return (misses / max(numtris, 1), misses / max(numverts, 1))
+
+def tipsify(tris, numverts, cache_size=DEFAULT_CACHE_SIZE):
+    '''
+    Reorder an (n, 3) triangle array for a vertex cache of cache_size.
+    '''
+    numtris = len(tris)
+    if numtris == 0 or numverts == 0:
+        return tris[:0]
+    flat = tris.reshape(-1)
+    # vertex -> triangles adjacency
+    order = numpy.argsort(flat, kind='stable')
+    offsets = numpy.zeros(numverts + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(flat, minlength=numverts), out=offsets[1:])
+    adjacency = (order // 3).tolist()
+    offsets = offsets.tolist()
+    tri_list = tris.tolist()
+
+    live = numpy.bincount(flat, minlength=numverts).tolist()
+    cache_time = [-cache_size - 1] * numverts
+    emitted = bytearray(numtris)
+    dead_end = []
+    output = []
+    timestamp = 0
+    cursor = 0
+    fan = 0
+    while fan >= 0:
+        candidates = []
+        for t in adjacency[offsets[fan]:offsets[fan+1]]:
+            if emitted[t]:
+                continue
+            emitted[t] = 1
+            output.append(t)
+            for v in tri_list[t]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if timestamp - cache_time[v] > cache_size:
+                    cache_time[v] = timestamp
+                    timestamp += 1
+        # next fanning vertex: the one that stays longest in the cache, if
+        # its remaining triangles fit in the cache. As in the paper's
+        # pseudo-code the best priority starts at -1, so a live candidate
+        # whose triangles don't fit (priority 0) still beats falling back to
+        # the dead-end stack: it is at least adjacent to the last fan.
+        fan = -1
+        best = -1
+        for v in candidates:
+            if live[v] > 0:
+                priority = 0
+                age = timestamp - cache_time[v]
+                if age + 2 * live[v] <= cache_size:
+                    priority = age
+                if priority > best:
+                    fan, best = v, priority
+        if fan < 0:
+            while dead_end:
+                v = dead_end.pop()
+                if live[v] > 0:
+                    fan = v
+                    break
+        if fan < 0:
+            while cursor < numverts:
+                if live[cursor] > 0:
+                    fan = cursor
+                    break
+                cursor += 1
+    return tris[numpy.array(output, dtype=numpy.int64)] if output else tris[:0]
+
+def reorder_vertices(vertdata, tris):
+    '''
+    Reorder vertices in order of first use by tris, dropping unreferenced
+    vertices. Returns (vertdata, tris) with tris remapped.
+    '''
+    flat = tris.reshape(-1)
+    used, first = numpy.unique(flat, return_index=True)
+    order = used[numpy.argsort(first)]
+    remap = numpy.zeros(len(vertdata), dtype=numpy.int64)
+    remap[order] = numpy.arange(len(order))
+    return (vertdata[order], remap[tris].astype(tris.dtype))
+
+def optimize_background(bgdata, cache_size=DEFAULT_CACHE_SIZE):
+    '''
+    Vertex cache optimize every submesh of a parsed background (parse_bg
+    with as_numpy=True). Each submesh becomes a single triangle list.
+    Returns (bgdata, report) with per submesh
+    (acmr before, atvr before, acmr after, atvr after).
+    '''
+    bgdata_new = []
+    report = []
+    for numverts,vertsize,vertdata,facelists in bgdata:
+        before = cache_stats(facelists, cache_size)
+        tris = tipsify(facelists_to_triangles(facelists).astype(index_dtype(numverts)), numverts, cache_size)
+        vertdata, tris = reorder_vertices(vertdata, tris)
+        indices = tris.reshape(-1)
+        facelists = [(PRIM_TRIANGLES, len(indices), indices)] if len(indices) else []
+        after = cache_stats(facelists, cache_size)
+        bgdata_new.append((len(vertdata), vertsize, vertdata, facelists))
+        report.append(before + after)
+    return (bgdata_new, report)
+
+def print_report(report):
+    for i, (acmr0, atvr0, acmr1, atvr1) in enumerate(report):
+        print(f'  submesh {i:>3d}: ACMR {acmr0:.3f} -> {acmr1:.3f}, ATVR {atvr0:.3f} -> {atvr1:.3f}')
+
+def main():
+    import argparse
+    import time
+    from parse_bg import parse_bg
+    parser = argparse.ArgumentParser(description='Report vertex cache efficiency before and after optimization')
+    parser.add_argument('filenames', metavar='FILENAME.HOD', nargs='+', help='Names of background meshes')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE, help='Vertex cache size')
+    args = parser.parse_args()
+
+    for filename in args.filenames:
+        start = time.perf_counter()
+        bgdata, report = optimize_background(parse_bg(filename, as_numpy=True), args.cache_size)
+        print(f'{filename} ({time.perf_counter() - start:.2f} s)')
+        print_report(report)
+
+if __name__ == '__main__':
+    main()
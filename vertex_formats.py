@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+# Copyright (c) 2014 Wladimir J. van der Laan
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+Compact GPU vertex formats for backgrounds. The file format stores a float4
+position and four color bytes per vertex; this converts parsed backgrounds
+to smaller encodings before the buffers are built:
+
+- float3:   float3 position + RGBA8 (16 bytes)
+- half:     half-float unit direction + RGBA8 (12 bytes)
+- oct:      octahedral-encoded unit direction in two snorm16 + RGBA8 (8 bytes)
+
+The direction encodings rely on the camera sitting at the center of the
+background sphere without depth testing, so that only the direction of a
+vertex matters. The shader places directions at DIRECTION_RADIUS.
+'''
+import numpy
+
+ENCODINGS = ['file', 'float3', 'half', 'oct']
+DIRECTION_ENCODINGS = {'half', 'oct'}
+
+# Distance at which direction-encoded vertices are drawn, between the near
+# and far planes of the viewer's projection
+DIRECTION_RADIUS = 10.0
+
+# Color of meshes without vertex colors: white after the shader's
+# normalization of signed bytes
+WHITE = numpy.array([127, 127, 127, 127], dtype=numpy.int8)
+
+VERTEX_DTYPES = {
+    'float3': numpy.dtype([('position', '<f4', 3), ('color', 'i1', 4)]),
+    'half': numpy.dtype([('position', '<f2', 4), ('color', 'i1', 4)]),
+    'oct': numpy.dtype([('position', '<i2', 2), ('color', 'i1', 4)]),
+}
+
+# GLSL (#version 120) expression computing the vec4 vertex position from the
+# inVertex attribute, per encoding
+SHADER_DECODE = {
+    'file': 'inVertex',
+    'float3': 'vec4(inVertex.xyz, 1.0)',
+    'half': f'vec4(inVertex.xyz * {DIRECTION_RADIUS:.1f}, 1.0)',
+    'oct': f'vec4(oct_decode(inVertex.xy) * {DIRECTION_RADIUS:.1f}, 1.0)',
+}
+SHADER_OCT_DECODE = b'''
+    vec3 oct_decode(vec2 e)
+    {
+        vec3 n = vec3(e, 1.0 - abs(e.x) - abs(e.y));
+        if (n.z < 0.0)
+            n.xy = (1.0 - abs(n.yx)) * vec2(n.x >= 0.0 ? 1.0 : -1.0, n.y >= 0.0 ? 1.0 : -1.0);
+        return normalize(n);
+    }
+'''
+
+def oct_encode(directions):
+    '''
+    Octahedral encoding of (n, 3) unit vectors to (n, 2) in [-1, 1].
+    '''
+    d = directions / numpy.abs(directions).sum(axis=1, keepdims=True)
+    xy = d[:, :2]
+    sign = numpy.where(xy >= 0.0, 1.0, -1.0)
+    folded = (1.0 - numpy.abs(xy[:, ::-1])) * sign
+    return numpy.where(d[:, 2:3] < 0.0, folded, xy)
+
+def oct_decode(e):
+    '''
+    Inverse of oct_encode, as done in the shader.
+    '''
+    n = numpy.concatenate((e, 1.0 - numpy.abs(e).sum(axis=1, keepdims=True)), axis=1)
+    sign = numpy.where(n[:, :2] >= 0.0, 1.0, -1.0)
+    n[:, :2] = numpy.where(n[:, 2:3] < 0.0, (1.0 - numpy.abs(n[:, 1::-1])) * sign, n[:, :2])
+    return n / numpy.linalg.norm(n, axis=1, keepdims=True)
+
+def encode_vertices(vertdata, encoding):
+    '''
+    Encode the vertices of a submesh (a structured array from parse_bg).
+    '''
+    out = numpy.empty(len(vertdata), dtype=VERTEX_DTYPES[encoding])
+    position = vertdata['position'][:, :3].astype(numpy.float64)
+    if encoding == 'float3':
+        out['position'] = position
+    else:
+        radius = numpy.linalg.norm(position, axis=1, keepdims=True)
+        direction = position / numpy.where(radius > 0.0, radius, 1.0)
+        if encoding == 'half':
+            out['position'][:, :3] = direction
+            out['position'][:, 3] = 1.0
+        else:
+            out['position'] = numpy.round(oct_encode(direction) * 32767.0)
+    if 'color' in vertdata.dtype.names:
+        out['color'] = vertdata['color']
+    else:
+        out['color'] = WHITE
+    return out
+
+def decode_positions(encoded, encoding):
+    '''
+    Vertex positions as the shader reconstructs them, for error measurement.
+    '''
+    position = encoded['position'].astype(numpy.float64)
+    if encoding == 'float3':
+        return position
+    if encoding == 'half':
+        return position[:, :3] * DIRECTION_RADIUS
+    return oct_decode(numpy.clip(position / 32767.0, -1.0, 1.0)) * DIRECTION_RADIUS
+
+def compact_background(bgdata, encoding):
+    '''
+    Convert a parsed background (parse_bg with as_numpy=True) to a compact
+    vertex encoding. Face lists are passed through unchanged.
+    '''
+    if encoding == 'file':
+        return bgdata
+    bgdata_new = []
+    for numverts,vertsize,vertdata,facelists in bgdata:
+        encoded = encode_vertices(vertdata, encoding)
+        bgdata_new.append((numverts, encoded.itemsize, encoded, facelists))
+    return bgdata_new
+
+def encoding_error(bgdata, encoding):
+    '''
+    Error introduced by an encoding over a whole background: maximum and mean
+    angle between the original and decoded vertex direction in degrees, the
+    maximum relative deviation of the original vertices from their
+    submesh's mean radius (direction encodings assume a sphere), and the
+    vertex buffer size.
+    '''
+    angles = []
+    spread = 0.0
+    size = 0
+    for numverts,vertsize,vertdata,facelists in bgdata:
+        if not numverts:
+            continue
+        position = vertdata['position'][:, :3].astype(numpy.float64)
+        if encoding == 'file':
+            decoded = position
+            size += vertdata.nbytes
+        else:
+            encoded = encode_vertices(vertdata, encoding)
+            decoded = decode_positions(encoded, encoding)
+            size += encoded.nbytes
+        a = position / numpy.linalg.norm(position, axis=1, keepdims=True)
+        b = decoded / numpy.linalg.norm(decoded, axis=1, keepdims=True)
+        # atan2 of cross and dot products is accurate for tiny angles
+        angles.append(numpy.degrees(numpy.arctan2(numpy.linalg.norm(numpy.cross(a, b), axis=1), (a * b).sum(axis=1))))
+        radius = numpy.linalg.norm(position, axis=1)
+        spread = max(spread, float(numpy.abs(radius / radius.mean() - 1.0).max()))
+    angles = numpy.concatenate(angles) if angles else numpy.zeros(1)
+    return {'max_angle': float(angles.max()), 'mean_angle': float(angles.mean()),
+            'radius_spread': spread, 'bytes': size}
+
+def main():
+    import argparse
+    from parse_bg import parse_bg
+    parser = argparse.ArgumentParser(description='Report the error of compact vertex encodings')
+    parser.add_argument('filenames', metavar='FILENAME.HOD', nargs='+', help='Names of background meshes')
+    args = parser.parse_args()
+
+    for filename in args.filenames:
+        bgdata = parse_bg(filename, as_numpy=True)
+        print(filename)
+        for encoding in ENCODINGS:
+            err = encoding_error(bgdata, encoding)
+            print(f"  {encoding:>6s}: {err['bytes']/1e6:8.3f} MB, max error {err['max_angle']*3600:8.3f}\", "
+                  f"mean {err['mean_angle']*3600:8.3f}\", radius spread {err['radius_spread']*100:.3f}%")
+
+if __name__ == '__main__':
+    main()
@@ -5,10 +5,12 @@
 '''
 Show Homeworld 2 backgrounds using OpenGL-based visualization.
 '''
-from OpenGL.extensions import alternate
 from OpenGL.GL import *
 from OpenGL.GL import shaders
 from OpenGL.GL.NV.primitive_restart import *
+from OpenGL.GL.ARB.half_float_vertex import *
+from OpenGL.GL.ARB.draw_elements_base_vertex import *
+from OpenGL.GL.ARB.multi_draw_indirect import *
 import ctypes
 import glfw
 import math
@@ -17,9 +19,20 @@ import os
 import random
 import time
 
-from math3d import perspective_matrix
 from glfw_platform import GLFWPlatform
+from gl_state import GLState, glGetAttribLocation
+from hod_fsck import check_hod
+from bg_cache import cache_path, load_cache, options_suffix, save_cache, source_stat
+from lrucache import LRUCache
+from mesh_store import MeshStore, build_shared_buffers
+from mesh_cleanup import cleanup_background, print_report as print_cleanup_report
+from mesh_ops import (PRIMITIVE_RESTART_NONE, PRIMITIVE_RESTART_CORE, PRIMITIVE_RESTART_NV,
+        build_buffers, merge_submeshes, triangulate)
+from program_cache import cached_program
 from parse_bg import parse_bg, PRIM_TRIANGLE_STRIP, PRIM_TRIANGLES
+from decimate import decimate_background
+from vertex_cache import optimize_background, print_report as print_cache_report
+from vertex_formats import ENCODINGS, SHADER_DECODE, SHADER_OCT_DECODE, compact_background
 from transformations import Arcball, quaternion_slerp, random_quaternion, quaternion_multiply, quaternion_about_axis
 
 window = 0
@@ -34,32 +47,65 @@ arcball.active = False
 animate = None # autospin
 fovy = 45 # field of vision in y - I don't know what original homeworld uses
 cur_time = nextframe_time = None
+vbo = ibo = None
+shared_format = None # vertex format shared by all submeshes, see shared_vertex_format
+draw_batches = None # multi-draw batches, see build_draw_batches
+shared_tables = None # draw table per file name, when drawing from the mesh store
+dibo = None # indirect draw buffer
+switch_background = 0 # requested change of background index
+gl_state = GLState() # GL state set by draw(), see gl_state.py
 
-# Options for primitive restart
-PRIMITIVE_RESTART_NONE = 0
-PRIMITIVE_RESTART_CORE = 1
-PRIMITIVE_RESTART_NV = 2
+# Parsed backgrounds that were shown in this session
+background_cache = LRUCache(256*1024*1024)
 
 # Primitive restart type supported (filled in in probe_extensions)
 primitive_restart_mode = PRIMITIVE_RESTART_NONE
 
+# glDrawElementsBaseVertex supported (filled in in probe_extensions),
+# otherwise indices are rebased to the start of the vertex buffer
+base_vertex_supported = False
+
+# Options for submitting the draw table
+MULTI_DRAW_NONE = 0 # one call per face list
+MULTI_DRAW = 1 # glMultiDrawElements, with rebased indices
+MULTI_DRAW_BASE_VERTEX = 2 # glMultiDrawElementsBaseVertex
+MULTI_DRAW_INDIRECT = 3 # glMultiDrawElementsIndirect from a buffer
+
+# Multi-draw type supported (filled in in probe_extensions)
+multi_draw_mode = MULTI_DRAW_NONE
+
+# Layout of a command in the indirect draw buffer
+DRAW_COMMAND_DTYPE = numpy.dtype([
+    ('count', '<u4'), ('instance_count', '<u4'), ('first_index', '<u4'),
+    ('base_vertex', '<i4'), ('base_instance', '<u4')])
+
+# GPU vertex encoding, see vertex_formats.py
+vertex_encoding = 'file'
+# Reorder triangles and vertices for the vertex cache, see vertex_cache.py
+optimize_meshes = False
+# Triangle budget for decimation, see decimate.py
+max_triangles = None
+# Weld all submeshes into one draw, see mesh_ops.merge_submeshes
+merge_meshes = False
+# Draw triangle lists even if primitive restart is supported
+triangle_lists = False
+# Remove degenerate and duplicate triangles, see mesh_cleanup.py
+cleanup_meshes = False
+
 gl_types = {
     PRIM_TRIANGLES: GL_TRIANGLES,
     PRIM_TRIANGLE_STRIP: GL_TRIANGLE_STRIP
 }
-PRIMITIVE_RESTART_INDEX = 65535
-
-# extension alternates for GL <2.0
-from OpenGL.GL.ARB.vertex_shader import *
-from OpenGL.GL.ARB.vertex_buffer_object import *
-from OpenGL.GL.ARB.vertex_program import *
-glGetAttribLocation = alternate('glGetAttribLocation', glGetAttribLocation, glGetAttribLocationARB)
-glEnableVertexAttribArray = alternate('glEnableVertexAttribArray', glEnableVertexAttribArray, glEnableVertexAttribArrayARB)
-glDisableVertexAttribArray = alternate('glDisableVertexAttribArray', glDisableVertexAttribArray, glDisableVertexAttribArrayARB)
-glVertexAttribPointer = alternate('glVertexAttribPointer', glVertexAttribPointer, glVertexAttribPointerARB)
-glGenBuffers = alternate('glGenBuffers', glGenBuffers, glGenBuffersARB)
-glBindBuffer = alternate('glBindBuffer', glBindBuffer, glBindBufferARB)
-glBufferData = alternate('glBufferData', glBufferData, glBufferDataARB)
+# GL type per index size in bytes
+index_types = {2: GL_UNSIGNED_SHORT, 4: GL_UNSIGNED_INT}
+
+# Position attribute (components, type, normalized) per vertex encoding
+position_formats = {
+    'file': (4, GL_FLOAT, False),
+    'float3': (3, GL_FLOAT, False),
+    'half': (4, GL_HALF_FLOAT, False),
+    'oct': (2, GL_SHORT, True),
+}
 
 # GLFW window hints for wayland
 # This needs https://github.com/glfw/glfw/pull/2061
@@ -89,48 +135,109 @@ def framebuffer_size_callback(window, w, h):
     force_rerender()
 
 def draw():
-    glViewport(0, 0, f_width, f_height)
-    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+    gl_state.viewport(f_width, f_height)
+    gl_state.call(glClear, GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
     # set up matrices
-    glMatrixMode(GL_PROJECTION)
-    glLoadMatrixf(perspective_matrix(fovy, f_width/f_height, 1.0, 100.0))
-    glMatrixMode(GL_MODELVIEW)
-    glLoadMatrixf(arcball.matrix().T)
+    gl_state.projection(fovy, f_width/f_height, 1.0, 100.0)
+    gl_state.modelview(arcball.matrix().T)
 
     # rendering time
-    if wireframe_mode:
-        glPolygonMode(GL_FRONT_AND_BACK, GL_LINE)
+    gl_state.polygon_mode(GL_LINE if wireframe_mode else GL_FILL)
+
+    # everything below is kept bound between frames, gl_state only issues
+    # the calls for what changed
+    gl_state.use_program(background_shader)
+    gl_state.bind_buffer(GL_ARRAY_BUFFER, vbo)
+    gl_state.bind_buffer(GL_ELEMENT_ARRAY_BUFFER, ibo)
+    gl_state.attrib_array(vertex_loc)
+    if shared_format is not None:
+        # all submeshes share one vertex format, point the attributes at
+        # the start of the buffer once
+        set_vertex_format(0, *shared_format)
+    if draw_batches is not None:
+        # one call per primitive type and index size, independent of the
+        # number of submeshes
+        if dibo is not None:
+            gl_state.bind_buffer(GL_DRAW_INDIRECT_BUFFER, dibo)
+        for typ, index_size, counts, offsets, base_vertices, indirect_offset in draw_batches:
+            gl_state.primitive_restart(primitive_restart_mode, index_size)
+            if dibo is not None:
+                gl_state.call(glMultiDrawElementsIndirect, gl_types[typ], index_types[index_size], ctypes.c_void_p(indirect_offset), len(counts), 0)
+            elif multi_draw_mode == MULTI_DRAW_BASE_VERTEX:
+                gl_state.call(glMultiDrawElementsBaseVertex, gl_types[typ], counts, index_types[index_size], offsets, len(counts), base_vertices)
+            else:
+                gl_state.call(glMultiDrawElements, gl_types[typ], counts, index_types[index_size], offsets, len(counts))
     else:
-        glPolygonMode(GL_FRONT_AND_BACK, GL_FILL)
-
-    if primitive_restart_mode == PRIMITIVE_RESTART_CORE:
-        glEnable(GL_PRIMITIVE_RESTART)
-        glPrimitiveRestartIndex(PRIMITIVE_RESTART_INDEX)
-    elif primitive_restart_mode == PRIMITIVE_RESTART_NV:
-        glEnableClientState(GL_PRIMITIVE_RESTART_NV)
-        glPrimitiveRestartIndexNV(PRIMITIVE_RESTART_INDEX)
-
-    shaders.glUseProgram(background_shader)
-    glBindBuffer(GL_ARRAY_BUFFER, vbo)
-    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, ibo)
-    glEnableVertexAttribArray(vertex_loc)
-    glEnableVertexAttribArray(color_loc)
-    prims = 0
-    for numverts,vertsize,vertdata_offset,facelists in nbgdata:
-        glVertexAttribPointer(vertex_loc, 4, GL_FLOAT, False, vertsize, ctypes.c_void_p(vertdata_offset))
-        glVertexAttribPointer(color_loc, 4, GL_BYTE, True, vertsize, ctypes.c_void_p(vertdata_offset+16))
-        for typ, count, facedata_offset in facelists:
-            glDrawElements(gl_types[typ], count, GL_UNSIGNED_SHORT, ctypes.c_void_p(facedata_offset))
-    glDisableVertexAttribArray(vertex_loc)
-    glDisableVertexAttribArray(color_loc)
-    glBindBuffer(GL_ARRAY_BUFFER, 0)
-    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
-    shaders.glUseProgram(0)
-    if primitive_restart_mode == PRIMITIVE_RESTART_CORE:
-        glDisable(GL_PRIMITIVE_RESTART)
-    elif primitive_restart_mode == PRIMITIVE_RESTART_NV:
-        glDisableClientState(GL_PRIMITIVE_RESTART_NV)
+        base_vertex = 0
+        for numverts,vertsize,vertdata_offset,attrib_offsets,facelists in nbgdata:
+            if shared_format is None:
+                set_vertex_format(vertdata_offset, vertsize, attrib_offsets)
+            elif base_vertex_supported:
+                base_vertex = vertdata_offset // vertsize
+            for typ, count, facedata_offset, index_size in facelists:
+                gl_state.primitive_restart(primitive_restart_mode, index_size)
+                if base_vertex:
+                    gl_state.call(glDrawElementsBaseVertex, gl_types[typ], count, index_types[index_size], ctypes.c_void_p(facedata_offset), base_vertex)
+                else:
+                    gl_state.call(glDrawElements, gl_types[typ], count, index_types[index_size], ctypes.c_void_p(facedata_offset))
+    gl_state.end_frame()
+
+def set_vertex_format(vertdata_offset, vertsize, attrib_offsets):
+    components, position_type, normalized = position_formats[vertex_encoding]
+    gl_state.attrib_pointer(vertex_loc, components, position_type, normalized, vertsize, vertdata_offset+attrib_offsets['position'])
+    if 'color' in attrib_offsets:
+        gl_state.attrib_array(color_loc)
+        gl_state.attrib_pointer(color_loc, 4, GL_BYTE, True, vertsize, vertdata_offset+attrib_offsets['color'])
+    else: # no vertex colors (ship meshes), draw in white
+        gl_state.attrib_array(color_loc, False)
+        gl_state.attrib_constant(color_loc, 1.0, 1.0, 1.0, 1.0)
+
+def shared_vertex_format(nbgdata):
+    '''
+    (vertsize, attrib_offsets) if all submeshes have the same vertex format,
+    so that they can be drawn from one set of attribute pointers with a
+    base vertex, otherwise None.
+    '''
+    formats = {(vertsize, tuple(sorted(attrib_offsets.items())))
+               for numverts,vertsize,vertdata_offset,attrib_offsets,facelists in nbgdata}
+    if len(formats) != 1:
+        return None
+    vertsize, attrib_offsets = formats.pop()
+    if any(vertdata_offset % vertsize for numverts,vertsize,vertdata_offset,attrib_offsets,facelists in nbgdata):
+        return None
+    return (vertsize, dict(attrib_offsets))
+
+def build_draw_batches(nbgdata, vertsize, base_vertex=True):
+    '''
+    Group the draw table by primitive type and index size into arrays of
+    counts, byte offsets and base vertices for multi-draw calls, plus the
+    matching indirect draw commands. Returns (batches, commands) where each
+    batch is (type, index size, counts, offsets, base vertices, byte offset
+    of its commands).
+    '''
+    groups = {}
+    for numverts,submesh_vertsize,vertdata_offset,attrib_offsets,facelists in nbgdata:
+        for typ, count, facedata_offset, index_size in facelists:
+            groups.setdefault((typ, index_size), []).append(
+                    (count, facedata_offset, vertdata_offset // vertsize if base_vertex else 0))
+    batches = []
+    commands = numpy.zeros(sum(len(draws) for draws in groups.values()), dtype=DRAW_COMMAND_DTYPE)
+    pos = 0
+    for (typ, index_size), draws in sorted(groups.items()):
+        draws = numpy.array(draws, dtype=numpy.int64).reshape(-1, 3)
+        counts = draws[:, 0].astype(numpy.int32)
+        offsets = draws[:, 1].astype(numpy.uintp)
+        base_vertices = draws[:, 2].astype(numpy.int32)
+        cmds = commands[pos:pos+len(draws)]
+        cmds['count'] = counts
+        cmds['instance_count'] = 1
+        cmds['first_index'] = draws[:, 1] // index_size
+        cmds['base_vertex'] = base_vertices
+        batches.append((typ, index_size, counts, (ctypes.c_void_p * len(offsets)).from_buffer(offsets),
+                        base_vertices, pos * DRAW_COMMAND_DTYPE.itemsize))
+        pos += len(draws)
+    return (batches, commands)
 
 def advance_time(deltatime):
     global animate
@@ -141,14 +248,18 @@ def advance_time(deltatime):
 
 def key_callback(window, key, scancode, action, mods):
     '''
-    Keyboard: w for wireframe mode
+    Keyboard: w for wireframe mode, n/p for next/previous background
     '''
-    global wireframe_mode, slow_flag, quit_flag
+    global wireframe_mode, slow_flag, quit_flag, switch_background
     if action == glfw.PRESS and mods == 0:
         if key == glfw.KEY_W:
             wireframe_mode = not wireframe_mode
         if key == glfw.KEY_S:
             slow_flag = not slow_flag
+        elif key == glfw.KEY_N:
+            switch_background += 1
+        elif key == glfw.KEY_P:
+            switch_background -= 1
         elif key == glfw.KEY_ESCAPE:
             quit_flag = True
 
@@ -171,105 +282,69 @@ def cursor_pos_callback(window, x, y):
         arcball.drag([x,y])
         force_rerender()
 
-def create_shaders():
+def create_shaders(use_cache=True):
     global background_shader, vertex_loc, color_loc
 
-    VERTEX_SHADER = shaders.compileShader(b"""
+    VERTEX_SHADER = b"""
     #version 120
     attribute vec4 inVertex;
     attribute vec4 inColor;
+    """ + (SHADER_OCT_DECODE if vertex_encoding == 'oct' else b'') + b"""
     void main()
     {
-        gl_Position = gl_ModelViewProjectionMatrix * inVertex;
+        gl_Position = gl_ModelViewProjectionMatrix * %s;
         gl_FrontColor = inColor.abgr;
     }
-    """, GL_VERTEX_SHADER)
+    """ % SHADER_DECODE[vertex_encoding].encode()
 
-    FRAGMENT_SHADER = shaders.compileShader(b"""
+    FRAGMENT_SHADER = b"""
     #version 120
     void main()
     {
         gl_FragColor = gl_Color;
-    }""", GL_FRAGMENT_SHADER)
-    background_shader = shaders.compileProgram(VERTEX_SHADER,FRAGMENT_SHADER)
+    }"""
+    start = time.perf_counter()
+    background_shader, hit = cached_program([(VERTEX_SHADER, GL_VERTEX_SHADER), (FRAGMENT_SHADER, GL_FRAGMENT_SHADER)], use_cache)
+    print(f"Shaders: {'loaded from program cache' if hit else 'compiled'} in {(time.perf_counter() - start)*1000:.1f} ms")
     vertex_loc = glGetAttribLocation(background_shader, b"inVertex")
     color_loc = glGetAttribLocation(background_shader, b"inColor")
 
-def create_vbos(bgdata):
-    global ibo,vbo,nbgdata
-    # Build vertex and index buffers and new bgdata structure
-    # that has pointers into the vertex and index buffers instead of
-    # data
-    allvertdata = []
-    allfacedata = []
-    vertdata_ptr = 0
-    facedata_ptr = 0
-    nbgdata = []
-    for numverts,vertsize,vertdata,facelists in bgdata:
-        vertdata_offset = vertdata_ptr
-        allvertdata.append(vertdata)
-        vertdata_ptr += len(vertdata)
-        nfacelists = []
-        for typ, count, facedata in facelists:
-            facedata_offset = facedata_ptr
-            allfacedata.append(facedata)
-            facedata_ptr += len(facedata)
-            nfacelists.append((typ, count, facedata_offset))
-        nbgdata.append((numverts, vertsize, vertdata_offset, nfacelists))
-
-    allvertdata = b''.join(allvertdata)
-    allfacedata = b''.join(allfacedata)
-
-    vbo = glGenBuffers(1)
-    glBindBuffer(GL_ARRAY_BUFFER, vbo)
-    glBufferData(GL_ARRAY_BUFFER, len(allvertdata), allvertdata, GL_STATIC_DRAW)
-    glBindBuffer(GL_ARRAY_BUFFER, 0)
-
-    ibo = glGenBuffers(1)
-    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, ibo)
-    glBufferData(GL_ELEMENT_ARRAY_BUFFER, len(allfacedata), allfacedata, GL_STATIC_DRAW)
-    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
-
-def concatenate_primitives(bgdata):
-    import struct
-    PRIMITIVE_RESTART = struct.pack('<H',65535)
-    bgdata_new = []
-    for numverts,vertsize,vertdata,facelists in bgdata:
-        # concatenate triangles, as well as triangle strips, into different buffers
-        triangles = []
-        triangle_strip = []
-
-        for typ, count, facedata in facelists:
-            assert(len(facedata) == 2*count)
-            if typ == PRIM_TRIANGLE_STRIP:
-                if triangle_strip:
-                    if primitive_restart_mode == PRIMITIVE_RESTART_NONE:
-                        # create two degenerate triangles in between
-                        triangle_strip.append(
-                                triangle_strip[-1][-2:] +
-                                facedata[:2])
-                    else:
-                        triangle_strip.append(PRIMITIVE_RESTART)
-                triangle_strip.append(facedata)
-            elif typ == PRIM_TRIANGLES:
-                triangles.append(facedata)
-            else:
-                raise ValueError(f'Unknown primitive type {typ}')
-
-        facelists_new = []
-        if triangle_strip:
-            joined = b''.join(triangle_strip)
-            facelists_new.append((PRIM_TRIANGLE_STRIP, len(joined)//2, joined))
-        if triangles:
-            joined = b''.join(triangles)
-            facelists_new.append((PRIM_TRIANGLES, len(joined)//2, joined))
+def create_vbos(buffers):
+    global ibo,vbo
+    allvertdata, allfacedata, nbgdata = buffers
+    # buffers may be views on a memory-mapped cache, upload them without copying
+    allvertdata = numpy.frombuffer(allvertdata, dtype=numpy.uint8)
+    allfacedata = numpy.frombuffer(allfacedata, dtype=numpy.uint8)
 
-        bgdata_new.append((numverts,vertsize,vertdata,facelists_new))
+    if vbo is not None:
+        gl_state.delete_buffers([vbo, ibo])
+    vbo = gl_state.create_buffer(GL_ARRAY_BUFFER, allvertdata)
+    ibo = gl_state.create_buffer(GL_ELEMENT_ARRAY_BUFFER, allfacedata)
+    set_draw_table(nbgdata)
 
-    return bgdata_new
+def set_draw_table(table, rebased=True):
+    '''
+    Draw the buffers with another draw table. rebased tells whether the
+    indices are relative to the start of the vertex buffer when base vertex
+    drawing is not supported, as build_buffers makes them.
+    '''
+    global dibo,nbgdata,shared_format,draw_batches
+    nbgdata = table
+    shared_format = shared_vertex_format(nbgdata)
+    if not rebased and not base_vertex_supported:
+        shared_format = None
+    draw_batches = commands = None
+    if shared_format is not None and multi_draw_mode != MULTI_DRAW_NONE:
+        draw_batches, commands = build_draw_batches(nbgdata, shared_format[0], multi_draw_mode != MULTI_DRAW)
+
+    if dibo is not None:
+        gl_state.delete_buffers([dibo])
+        dibo = None
+    if multi_draw_mode == MULTI_DRAW_INDIRECT and draw_batches is not None:
+        dibo = gl_state.create_buffer(GL_DRAW_INDIRECT_BUFFER, commands)
 
 def probe_extensions():
-    global primitive_restart_mode
+    global primitive_restart_mode, vertex_encoding, base_vertex_supported, multi_draw_mode
     primitive_restart_mode = PRIMITIVE_RESTART_NONE
     if glInitGl31VERSION() and glPrimitiveRestartIndex: # 3.1+
         primitive_restart_mode = PRIMITIVE_RESTART_CORE
@@ -277,22 +352,153 @@ def probe_extensions():
         primitive_restart_mode = PRIMITIVE_RESTART_NV
     else:
         print("Warning: Primitive restart not supported, falling back to slow path")
+    base_vertex_supported = bool((glInitGl32VERSION() or glInitDrawElementsBaseVertexARB()) and glDrawElementsBaseVertex)
+    multi_draw_mode = MULTI_DRAW_NONE
+    if base_vertex_supported and (glInitGl43VERSION() or glInitMultiDrawIndirectARB()) and glMultiDrawElementsIndirect:
+        multi_draw_mode = MULTI_DRAW_INDIRECT
+    elif base_vertex_supported and glMultiDrawElementsBaseVertex:
+        multi_draw_mode = MULTI_DRAW_BASE_VERTEX
+    elif not base_vertex_supported and glMultiDrawElements:
+        multi_draw_mode = MULTI_DRAW
+    if vertex_encoding == 'half' and not (glInitGl30VERSION() or glInitHalfFloatVertexARB()):
+        print("Warning: Half-float vertices not supported, falling back to float3")
+        vertex_encoding = 'float3'
+
+def cache_suffix():
+    '''
+    Suffix of render-ready cache files for the current mesh processing
+    options.
+    '''
+    return options_suffix(cleanup=cleanup_meshes, max_triangles=max_triangles, merge=merge_meshes,
+            triangle_lists=triangle_lists, rebased=not base_vertex_supported,
+            optimize=optimize_meshes, encoding=vertex_encoding)
+
+def load_background(filename, use_cache=True):
+    '''
+    Load the render-ready buffers for a background, from the cache if
+    possible. Returns None if the file is invalid.
+    '''
+    if use_cache:
+        cachefile = cache_path(filename, cache_suffix())
+        buffers = load_cache(cachefile, filename, primitive_restart_mode)
+        if buffers is not None:
+            return buffers
+
+    # refuse broken files before they reach the GL upload path
+    report = check_hod(filename)
+    if report.errors:
+        print(f'{filename} is not a valid HOD file:')
+        for error in report.errors:
+            print(f'  {error}')
+        return None
+
+    bgdata = parse_bg(filename, use_mmap=True, as_numpy=True)
+    if cleanup_meshes:
+        bgdata, report = cleanup_background(bgdata)
+        print(f'Cleanup of {filename}:')
+        print_cleanup_report(report)
+    if max_triangles is not None:
+        bgdata = decimate_background(bgdata, max_triangles)
+    if merge_meshes:
+        numverts = sum(mesh[0] for mesh in bgdata)
+        bgdata = merge_submeshes(bgdata)
+        print(f'Merged {filename}: {numverts} -> {bgdata[0][0]} vertices')
+    if optimize_meshes:
+        bgdata, report = optimize_background(bgdata)
+        print(f'Vertex cache optimization of {filename}:')
+        print_cache_report(report)
+    if triangle_lists or primitive_restart_mode == PRIMITIVE_RESTART_NONE:
+        # without primitive restart, lists are faster than strips joined by
+        # degenerate triangles
+        bgdata = triangulate(bgdata)
+    bgdata = compact_background(bgdata, vertex_encoding)
+    buffers = build_buffers(bgdata, primitive_restart_mode, rebase=not base_vertex_supported)
+    if use_cache:
+        try:
+            save_cache(cachefile, filename, primitive_restart_mode, *buffers)
+        except OSError as e:
+            print(f'Warning: could not write cache {cachefile}: {e}')
+    return buffers
+
+def load_background_cached(filename, use_cache=True):
+    '''
+    Load a background through the in-process cache, keyed by file identity
+    primitive restart mode and mesh processing options.
+    '''
+    key = (os.path.abspath(filename),) + source_stat(filename) + (primitive_restart_mode, vertex_encoding, optimize_meshes, max_triangles, merge_meshes, triangle_lists, cleanup_meshes, base_vertex_supported)
+    buffers = background_cache.get(key)
+    if buffers is None:
+        buffers = load_background(filename, use_cache)
+        if buffers is not None:
+            background_cache.put(key, buffers, len(buffers[0]) + len(buffers[1]))
+    return buffers
+
+def load_shared_backgrounds(filenames, store_dir):
+    '''
+    Add backgrounds to the mesh store and upload the distinct blocks of all
+    of them once, see mesh_store.build_shared_buffers. Switching between
+    them then only changes the draw table.
+    '''
+    global shared_tables
+    store = MeshStore(store_dir)
+    names = {}
+    for filename in filenames:
+        # unique per absolute path, like the render-ready cache
+        name = os.path.splitext(os.path.basename(cache_path(filename)))[0]
+        store.add_background(filename, name)
+        names[filename] = name
+    vertdata, facedata, tables = build_shared_buffers(store, sorted(set(names.values())))
+    shared_tables = {filename: tables[name] for filename, name in names.items()}
+    create_vbos((vertdata, facedata, shared_tables[filenames[0]]))
+    print(f'Mesh store: {len(filenames)} backgrounds in {(len(vertdata) + len(facedata))/1e6:.2f} MB of buffers')
+
+def show_background(window, filename, use_cache=True):
+    if shared_tables is not None:
+        # indices in the store are relative to their submesh
+        set_draw_table(shared_tables[filename], rebased=False)
+        glfw.set_window_title(window, "homeworld2 background: " + os.path.basename(filename))
+        return True
+    try:
+        buffers = load_background_cached(filename, use_cache)
+    except (OSError, KeyError, ValueError) as e:
+        print(f'Could not load {filename}: {e}')
+        return False
+    if buffers is None:
+        return False
+    create_vbos(buffers)
+    glfw.set_window_title(window, "homeworld2 background: " + os.path.basename(filename))
+    return True
 
 def parse_arguments():
     import argparse
     parser = argparse.ArgumentParser(description='Homeworld 2 background viewer')
-    parser.add_argument('filename', metavar='FILENAME.HOD', help='Name of background mesh')
+    parser.add_argument('filenames', metavar='FILENAME.HOD', nargs='+', help='Name of background mesh, n/p switch between several')
     parser.add_argument('--randomize', action='store_true', help='Randomize initial orientation and movement')
     parser.add_argument('--slow', action='store_true', help='Start in slow mode')
     parser.add_argument('--background', action='store_true', help='Render to desktop background')
+    parser.add_argument('--no-cache', action='store_true', help='Do not use or write the render-ready and shader program caches')
+    parser.add_argument('--vertex-format', choices=ENCODINGS, default='file', help='GPU vertex encoding: as in the file (20 bytes), float3 (16), half (12) or oct (8)')
+    parser.add_argument('--optimize', action='store_true', help='Reorder triangles and vertices for the post-transform vertex cache')
+    parser.add_argument('--cleanup', action='store_true', help='Remove degenerate and duplicate triangles')
+    parser.add_argument('--triangle-lists', action='store_true', help='Convert triangle strips to lists, as is done when primitive restart is not supported')
+    parser.add_argument('--merge', action='store_true', help='Weld all submeshes into one vertex and index buffer, drawn with one call')
+    parser.add_argument('--max-triangles', type=int, help='Decimate backgrounds to at most this many triangles')
+    parser.add_argument('--mesh-store', metavar='DIR', help='Add the backgrounds to a content-addressed mesh store and keep all of them in one set of GPU buffers that holds shared submeshes once; mesh processing options are ignored')
+    parser.add_argument('--cache-budget', type=int, default=256, help='Memory budget in MB for backgrounds kept in memory')
     return parser.parse_args()
 
 def main():
-    global animate, quit_flag, slow_flag, cur_time, nextframe_time
+    global animate, quit_flag, slow_flag, cur_time, nextframe_time, switch_background, vertex_encoding, optimize_meshes, max_triangles, merge_meshes, triangle_lists, cleanup_meshes
 
     args = parse_arguments()
-    # fetch data
-    bgdata = parse_bg(args.filename)
+    background_cache.budget = args.cache_budget * 1024 * 1024
+    vertex_encoding = args.vertex_format
+    optimize_meshes = args.optimize
+    max_triangles = args.max_triangles
+    merge_meshes = args.merge
+    triangle_lists = args.triangle_lists
+    cleanup_meshes = args.cleanup
+    current = 0
 
     # initialization
     if not glfw.init():
@@ -309,7 +515,7 @@ def main():
         # side there seems to be no way to set this.
         glfw.window_hint(GLFW_WAYLAND_SHELL_LAYER, ZWLR_LAYER_SHELL_V1_LAYER_BACKGROUND)
 
-    window = glfw.create_window(w_width, w_height, "homeworld2 background: " + os.path.basename(args.filename), None, None)
+    window = glfw.create_window(w_width, w_height, "homeworld2 background: " + os.path.basename(args.filenames[current]), None, None)
     if not window:
         print('Could not create GLFW window')
         glfw.terminate()
@@ -330,9 +536,23 @@ def main():
 
     probe_extensions()
     print(f"Primitive restart mode: {['NONE','CORE','NV'][primitive_restart_mode]}")
-    create_shaders()
-    bgdata = concatenate_primitives(bgdata)
-    create_vbos(bgdata)
+    print(f"Base vertex: {'glDrawElementsBaseVertex' if base_vertex_supported else 'rebased indices'}")
+    print(f"Multi-draw mode: {['NONE','MULTI','BASE_VERTEX','INDIRECT'][multi_draw_mode]}")
+    if args.mesh_store is not None:
+        # the store holds the meshes as in the file
+        vertex_encoding = 'file'
+    create_shaders(not args.no_cache)
+    # fetch data
+    if args.mesh_store is not None:
+        try:
+            load_shared_backgrounds(args.filenames, args.mesh_store)
+        except (OSError, KeyError, ValueError) as e:
+            print(f'Could not load backgrounds into the mesh store: {e}')
+            glfw.terminate()
+            return
+    if not show_background(window, args.filenames[current], not args.no_cache):
+        glfw.terminate()
+        return
 
     window_size_callback(window, *glfw.get_window_size(window))
     framebuffer_size_callback(window, *glfw.get_framebuffer_size(window))
@@ -352,6 +572,11 @@ def main():
 
     while not glfw.window_should_close(window) and not quit_flag:
         cur_time = glfw.get_time()
+        if switch_background:
+            current = (current + switch_background) % len(args.filenames)
+            switch_background = 0
+            show_background(window, args.filenames[current], not args.no_cache)
+            force_rerender()
         if slow_flag:
             timescale = 0.005
         else:
@@ -380,6 +605,10 @@ def main():
         else:
             glfw.wait_events()
 
+    print(gl_state.frame_report())
+    if len(args.filenames) > 1:
+        stats = background_cache.stats()
+        print(f"Background cache: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions")
 
 if __name__ == '__main__':
     main()